@@ -1,7 +1,18 @@
 import arcpy
+import hashlib
+import json
+import math
+import numpy as np
 import os
 import psycopg2
 
+import dry_run
+import intersection_nodes
+import stage_metrics
+import street_store
+from buffer_rules import buffer_size_text, default_rules_file, levels_to_mask, load_buffer_table, parse_buffer_size
+from crash_db import fetch_db_speed_limits_async
+
 # Define the input feature classes
 streets_fc = "CTN_AFP_Subset_2"
 crashes_fc = "Crashes_Subset_2"
@@ -18,224 +29,943 @@ if not arcpy.Exists(temp_gdb):
     arcpy.management.CreateFileGDB(os.path.dirname(temp_gdb), os.path.basename(temp_gdb))
 print("Temporary file geodatabase created.")
 
-# Define buffer size mapping based on street level combinations
-buffer_size_mapping = {
-    frozenset([1, 2]): "50 Feet",
-    frozenset([1, 3]): "50 Feet",
-    frozenset([1, 4]): "60 Feet",
-    frozenset([1, 5]): "70 Feet",
-    frozenset([2, 3]): "50 Feet",
-    frozenset([2, 4]): "60 Feet",
-    frozenset([2, 5]): "70 Feet",
-    frozenset([3, 4]): "60 Feet",
-    frozenset([3, 5]): "70 Feet",
-    frozenset([4, 5]): "70 Feet",
-    frozenset([1, 2, 3]): "50 Feet",
-    frozenset([1, 2, 4]): "60 Feet",
-    frozenset([1, 2, 5]): "70 Feet",
-    frozenset([1, 3, 4]): "60 Feet",
-    frozenset([1, 3, 5]): "70 Feet",
-    frozenset([1, 4, 5]): "70 Feet",
-    frozenset([2, 3, 4]): "60 Feet",
-    frozenset([2, 3, 5]): "70 Feet",
-    frozenset([2, 4, 5]): "70 Feet",
-    frozenset([3, 4, 5]): "70 Feet",
-    frozenset([1, 2, 3, 4]): "60 Feet",
-    frozenset([1, 2, 3, 5]): "70 Feet",
-    frozenset([1, 2, 4, 5]): "70 Feet",
-    frozenset([1, 3, 4, 5]): "70 Feet",
-    frozenset([2, 3, 4, 5]): "70 Feet",
-    frozenset([1, 2, 3, 4, 5]): "70 Feet",
-}
-
-default_buffer_size = "50 Feet"
-
-try:
-    # Function to get buffer size based on street levels
-    def get_buffer_size(street_levels):
-        street_levels_set = frozenset(street_levels)
-        return buffer_size_mapping.get(street_levels_set, default_buffer_size)
-
-    # Remove existing feature class if it exists in the project geodatabase
-    if arcpy.Exists(buffer_fc):
-        arcpy.management.Delete(buffer_fc)
-        print(f"Deleted existing {buffer_fc}")
-
-    # Add field to flag crashes near intersections
-    if "Near_Intersection" not in [f.name for f in arcpy.ListFields(crashes_fc)]:
-        arcpy.management.AddField(crashes_fc, "Near_Intersection", "SHORT")
-        print("Near_Intersection field added successfully.")
-
-    # Identify intersection points with street levels
-    intersection_points = os.path.join(temp_gdb, "Intersection_Points")
-    if arcpy.Exists(intersection_points):
-        arcpy.management.Delete(intersection_points)
-        print(f"Deleted existing {intersection_points}")
+# Incremental mode: keep the buffers while the street network is unchanged and only assign crashes that are
+# new, edited or near street segments that changed since the last run. The state of the last run is kept in state_file.
+incremental_mode = False
+state_file = os.path.join(os.path.dirname(project_gdb), "Speed_Limit_Assignment_State.json")
+
+# Checkpointing: the finished steps of a run, and during the crash assignment the results up to the last OBJECTID,
+# are appended to checkpoint_file (every checkpoint_every crashes in the assignment, only the crashes since the last
+# save). A rerun on the same streets, crashes and rules resumes from the checkpoint instead of starting over.
+# The checkpoint is removed when the run completes.
+checkpoint_file = os.path.join(os.path.dirname(project_gdb), "Speed_Limit_Assignment_Checkpoint.jsonl")
+checkpoint_every = 50000
+
+# Result table (result_table.py): Crash_Id, Near_Intersection, Assigned_Speed_Limit, DB_Speed_Limit and the segment ID
+# and distance of the nearest street for every crash, as GeoParquet part files of at most result_table_part_rows
+# crashes in result_table_dir ("arrow" writes memory-mappable Arrow IPC parts instead). None writes no table.
+result_table_dir = None  # e.g. os.path.join(os.path.dirname(project_gdb), "Crash_Speed_Limits")
+result_table_format = "parquet"
+result_table_part_rows = 500000
+
+# With geodatabase_copy = False the crashes are read from crashes_fc in place and the results only go to the result
+# table; output_copy_fc is neither created nor updated. Incremental runs update the copy, so they need it.
+geodatabase_copy = True
+
+# Instrumentation: every stage appends a JSON line (wall/CPU time, rows, spatial test counts, cursor opens) to the
+# metrics log. Stages named in profile_stages run under cProfile (<stage>.prof), stages in sample_stages write a
+# flamegraph-ready folded stack dump (<stage>.folded), both into metrics_dir.
+metrics_dir = os.path.dirname(project_gdb)
+stage_metrics.metrics_log = os.path.join(metrics_dir, "Speed_Limit_Assignment_Metrics.jsonl")
+profile_stages = []
+sample_stages = []
+
+# Dry run: assign a stratified random sample of dry_run_sample_size crashes (spread over a dry_run_strata x dry_run_strata
+# grid of the crash extent) with buffers only around the intersections near them, extrapolate every stage's runtime to
+# the full data and report the expected near-intersection share and speed limit distribution. Only temp_gdb is written.
+dry_run_mode = False
+dry_run_sample_size = 2000
+dry_run_strata = 10
+dry_run_seed = 0
+if dry_run_mode:
+    incremental_mode = False
+    checkpoint_file = None
+    buffer_fc = os.path.join(temp_gdb, "Customized_Buffers_Dry_Run")
+    output_copy_fc = os.path.join(temp_gdb, "Crashes_Dry_Run_Sample")
+    metrics_dir = os.path.dirname(temp_gdb)
+    stage_metrics.metrics_log = os.path.join(metrics_dir, "Speed_Limit_Assignment_Metrics.jsonl")
+    result_table_dir = None
+    geodatabase_copy = True
+if not geodatabase_copy:
+    if not result_table_dir:
+        raise ValueError("geodatabase_copy = False needs a result_table_dir for the results.")
+    incremental_mode = False
+crash_source_fc = output_copy_fc if geodatabase_copy else crashes_fc
+
+# Buffer size rules by street level combination, compiled into a lookup table indexed by a street level bitmask.
+# Point buffer_rules_file to another rule set to switch rules without code edits. Relative paths depend on the working
+# directory (the project folder in an ArcGIS Pro Notebook), so build them from the rules folder next to this script,
+# e.g. os.path.join(os.path.dirname(default_rules_file), "buffer_sizes_third_attempt.csv").
+buffer_rules_file = default_rules_file
+buffer_distances, buffer_unit = load_buffer_table(buffer_rules_file)
+max_buffer_distance = max(buffer_distances)
+
+# Customized_Buffers holds circle polygons for map display. The assignment only needs the buffer centers and radii,
+# so set buffer_polygons = False to write the buffers as points with their Buffer_Size instead.
+buffer_polygons = True
+
+# Intersection nodes are extracted from the street store (intersection_nodes.py): street endpoints and crossings within
+# node_snap_tolerance (in the street layer's units) of each other become one node. Set native_intersection_nodes = False
+# to use arcpy.analysis.Intersect, which writes one point per pair of intersecting segments.
+native_intersection_nodes = True
+node_snap_tolerance = 0.01
+
+# CR3 speed limits are fetched in the background while the crashes are assigned, over db_connections pooled
+# connections to the PostgreSQL database
+db_connections = 4
+
+# Crashes away from intersections are matched to their nearest street in batches of this size
+nearest_batch_size = 10000
+
+
+def connect_database():
+    return psycopg2.connect(
+        dbname="YOUR_DATABSE",
+        user="YOUR_USERNAME",
+        password="YOUR_PASSWORD",
+        host="YOUR_HOST"
+    )
+
+
+# Uniform grid over a list of extents (x_min, y_min, x_max, y_max): each cell lists the positions of the extents
+# overlapping it (their index in the list, or the matching entry of positions when given)
+def build_grid(extents, positions=None):
+    x_min = min(extent[0] for extent in extents)
+    y_min = min(extent[1] for extent in extents)
+    x_max = max(extent[2] for extent in extents)
+    y_max = max(extent[3] for extent in extents)
+
+    # Roughly one extent per cell
+    cell_size = max(x_max - x_min, y_max - y_min) / math.sqrt(len(extents)) or 1.0
+    n_cols = int((x_max - x_min) / cell_size) + 1
+    n_rows = int((y_max - y_min) / cell_size) + 1
+
+    cells = {}
+    for position, extent in zip(range(len(extents)) if positions is None else positions, extents):
+        col_start = min(int((extent[0] - x_min) / cell_size), n_cols - 1)
+        col_end = min(int((extent[2] - x_min) / cell_size), n_cols - 1)
+        row_start = min(int((extent[1] - y_min) / cell_size), n_rows - 1)
+        row_end = min(int((extent[3] - y_min) / cell_size), n_rows - 1)
+        for col in range(col_start, col_end + 1):
+            for row in range(row_start, row_end + 1):
+                cells.setdefault((col, row), []).append(position)
+
+    return {
+        "cells": cells,
+        "x_min": x_min,
+        "y_min": y_min,
+        "cell_size": cell_size,
+        "n_cols": n_cols,
+        "n_rows": n_rows,
+    }
+
+
+# Grid cell holding a point
+def grid_cell(grid, x, y):
+    col = math.floor((x - grid["x_min"]) / grid["cell_size"])
+    row = math.floor((y - grid["y_min"]) / grid["cell_size"])
+    return col, row
+
+
+# Vertex lists of the parts of a polyline (true curves are densified first)
+def polyline_parts(shape):
+    if shape.hasCurves:
+        shape = shape.densify("ANGLE", 1.0, 0.01)
+    return [[(point.X, point.Y) for point in part if point] for part in shape]
+
+
+# Read the streets once into a compact array store (see street_store.py) instead of keeping arcpy geometries
+def load_street_store(streets_fc):
+    with stage_metrics.opened(arcpy.da.SearchCursor(streets_fc, ["OID@", "SHAPE@", "STREET_LEVEL", "SPEED_LIMIT"])) as street_cursor:
+        store = street_store.build_street_store(
+            (street_row[0], street_row[2], street_row[3], polyline_parts(street_row[1]))
+            for street_row in street_cursor
+            if street_row[1] is not None
+        )
+    print(f"Street store loaded: {len(store['ids'])} segments, {len(store['coords'])} vertices.")
+    return store
+
+
+# Grid index over the street segments that carry a speed limit (done once per run)
+def build_street_index(store):
+    # Segments with a NULL speed limit are never picked by the nearest-street search
+    positions = np.flatnonzero(~np.isnan(store["speeds"]))
+    if not len(positions):
+        return None
+
+    street_index = build_grid(store["bounds"][positions].tolist(), positions.tolist())
+    street_index["store"] = store
+    print(f"Street index built: {len(positions)} segments in {len(street_index['cells'])} grid cells.")
+    return street_index
+
+
+# Grid index over the extents of the buffer circles (x, y, radius) for the point-in-buffer test
+def build_buffer_index(buffer_circles):
+    if not buffer_circles:
+        return None
+    buffer_index = build_grid([(x - radius, y - radius, x + radius, y + radius) for x, y, radius in buffer_circles])
+    print(f"Buffer index built: {len(buffer_circles)} buffers in {len(buffer_index['cells'])} grid cells.")
+    return buffer_index
+
+
+# Positions of all buffers containing the point (x, y), i.e. within their radius of their center. Only buffers whose
+# extent overlaps the point's cell are compared, and each of them once; overlapping buffers are all returned.
+def buffers_containing(buffer_index, buffer_circles, x, y):
+    if buffer_index is None:
+        return []
+    positions = buffer_index["cells"].get(grid_cell(buffer_index, x, y), ())
+    stage_metrics.counters["within_distance"] += len(positions)
+    return [
+        position
+        for position in positions
+        if math.hypot(x - buffer_circles[position][0], y - buffer_circles[position][1]) <= buffer_circles[position][2]
+    ]
+
+
+# Cells on the square ring at distance `ring` around (col, row)
+def ring_cells(col, row, ring):
+    if ring == 0:
+        return [(col, row)]
+    cells = []
+    for offset in range(-ring, ring + 1):
+        cells.append((col + offset, row - ring))
+        cells.append((col + offset, row + ring))
+    for offset in range(-ring + 1, ring):
+        cells.append((col - ring, row + offset))
+        cells.append((col + ring, row + offset))
+    return cells
+
+
+# Speed limit of, distance to and OBJECTID of the nearest street segment, searching outward ring by ring until no closer segment can exist.
+# Gives the same answer as scanning every segment in cursor order: ties go to the segment read first.
+def find_nearest_speed_limit(street_index, x, y):
+    if street_index is None:
+        return None, None, None
+
+    store = street_index["store"]
+    cells = street_index["cells"]
+    cell_size = street_index["cell_size"]
+    col, row = grid_cell(street_index, x, y)
+    max_ring = max(abs(col), abs(street_index["n_cols"] - 1 - col), abs(row), abs(street_index["n_rows"] - 1 - row))
+
+    nearest_position = None
+    nearest_distance = float('inf')
+    seen = set()
+    for ring in range(max_ring + 1):
+        # Distances to all segments first reached on this ring are computed in one vectorized call
+        ring_positions = []
+        for cell in ring_cells(col, row, ring):
+            for position in cells.get(cell, ()):
+                if position not in seen:
+                    seen.add(position)
+                    ring_positions.append(position)
+        if ring_positions:
+            stage_metrics.counters["street_distance"] += len(ring_positions)
+            position, distance = street_store.nearest_street(store, ring_positions, x, y)
+            if distance < nearest_distance or (distance == nearest_distance and position < nearest_position):
+                nearest_distance = distance
+                nearest_position = position
+        # Every segment not seen yet lies at least `ring` cells away from the point
+        if nearest_distance < ring * cell_size:
+            break
+
+    if nearest_position is None:
+        return None, nearest_distance, None
+    return int(store["speeds"][nearest_position]), nearest_distance, int(store["ids"][nearest_position])
+
+
+# find_nearest_speed_limit for many points at once. The segments in the 3x3 cells around every point go through one
+# batched distance call (street_store.nearest_streets). A result closer than one cell size is final, since every
+# segment outside those cells is at least that far; the remaining points fall back to the ring search.
+def find_nearest_speed_limits(street_index, xs, ys):
+    if street_index is None:
+        return [None] * len(xs), [None] * len(xs), [None] * len(xs)
+
+    store = street_index["store"]
+    cells = street_index["cells"]
+    candidate_offsets = [0]
+    candidates = []
+    for x, y in zip(xs, ys):
+        col, row = grid_cell(street_index, x, y)
+        positions = set()
+        for ring in (0, 1):
+            for cell in ring_cells(col, row, ring):
+                positions.update(cells.get(cell, ()))
+        candidates.extend(positions)
+        candidate_offsets.append(len(candidates))
+    stage_metrics.counters["street_distance"] += len(candidates)
+    nearest_positions, nearest_distances = street_store.nearest_streets(store, xs, ys, candidate_offsets, candidates)
+
+    speed_limits = []
+    distances = []
+    segment_ids = []
+    for x, y, position, distance in zip(xs, ys, nearest_positions, nearest_distances):
+        if distance < street_index["cell_size"]:
+            speed_limits.append(int(store["speeds"][position]))
+            distances.append(float(distance))
+            segment_ids.append(int(store["ids"][position]))
+        else:
+            speed_limit, distance, segment_id = find_nearest_speed_limit(street_index, x, y)
+            speed_limits.append(speed_limit)
+            distances.append(distance)
+            segment_ids.append(segment_id)
+    return speed_limits, distances, segment_ids
+
+
+# Resolve the crashes waiting for their nearest street: [(OBJECTID, crash key, x, y), ...]
+def assign_nearest_batch(street_index, pending, assignment_results, crash_state, crash_hashes):
+    if not pending:
+        return
+    speed_limits, distances, segment_ids = find_nearest_speed_limits(
+        street_index, [crash[2] for crash in pending], [crash[3] for crash in pending])
+    for (object_id, crash_key, _, _), speed_limit, distance, segment_id in zip(pending, speed_limits, distances, segment_ids):
+        # Assign the speed limit from the nearest street
+        if speed_limit is not None:
+            assignment_results[object_id][1] = speed_limit
+        crash_state[crash_key] = [crash_hashes.get(crash_key), distance, segment_id]
+    pending.clear()
+
+
+# Result table row of a crash read with OBJECTID, SHAPE@XY, Crash_Id (and Near_Intersection, Assigned_Speed_Limit from
+# the copy): the segment ID and distance come from the crash state, which keeps no segment for crashes near an
+# intersection or from the state of a run before segment IDs were recorded
+def result_row(row, assignment_results, speed_limit_dict, crash_state):
+    object_id, (x, y), crash_id = row[:3]
+    near_intersection, assigned_speed_limit = row[3:5] if len(row) > 3 else assignment_results[object_id]
+    state = crash_state.get(str(crash_id))
+    segment_id = state[2] if state and len(state) > 2 else None
+    distance = state[1] if segment_id is not None else None
+    return (None if crash_id is None else int(crash_id), near_intersection, assigned_speed_limit,
+            speed_limit_dict.get(str(crash_id)), segment_id, distance, x, y)
+
+
+# Store positions of the candidate streets that cross a circle of the given radius around (x, y).
+# Buffers are circles around intersection points; with radius 0 (the intersection point itself) no street crosses,
+# as a line can only touch a point.
+def crossing_positions(store, candidate_oids, x, y, radius):
+    positions = np.array([store["positions"][oid] for oid in candidate_oids if oid in store["positions"]], dtype=np.int64)
+    stage_metrics.counters["crosses"] += len(positions)
+    return positions[street_store.streets_crossing_circle(store, positions, x, y, radius)]
+
+
+# Store positions of the streets a buffer takes its street levels and speed limit from: the segments incident to its
+# intersection node, looked up in the node adjacency whether or not they leave the buffer, plus the other candidates
+# that pass through the buffer (the only ones that need the crossing test). Points from Intersect have no adjacency.
+def buffer_street_positions(store, incident_oids, candidate_oids, x, y, radius):
+    incident = np.array([store["positions"][oid] for oid in incident_oids if oid in store["positions"]], dtype=np.int64)
+    stage_metrics.counters["adjacency"] += len(incident)
+    other_oids = [oid for oid in candidate_oids if oid not in incident_oids]
+    return np.union1d(incident, crossing_positions(store, other_oids, x, y, radius))
+
+
+# Street levels of the streets of a buffer around (x, y)
+def buffer_street_levels(store, incident_oids, candidate_oids, x, y, radius):
+    levels = store["levels"][buffer_street_positions(store, incident_oids, candidate_oids, x, y, radius)]
+    return {int(level) for level in levels if level in [1, 2, 3, 4, 5]}
+
+
+# Highest speed limit of the streets of a buffer around (x, y) (None when none of them has one)
+def buffer_max_speed_limit(store, incident_oids, candidate_oids, x, y, radius):
+    speeds = store["speeds"][buffer_street_positions(store, incident_oids, candidate_oids, x, y, radius)]
+    speeds = speeds[~np.isnan(speeds)]
+    return int(speeds.max()) if len(speeds) else None
+
+
+def start_stage(name, rows_in=None):
+    return stage_metrics.start_stage(name, rows_in, profile=name in profile_stages, sample=name in sample_stages)
+
+
+# Records of the finished stages of this run
+stage_records = []
+
+
+def end_stage(stage, rows_out=None):
+    record = stage_metrics.end_stage(stage, rows_out, metrics_dir)
+    stage_records.append(record)
+    return record
+
+
+def hash_values(values):
+    return hashlib.sha1(repr(values).encode("utf-8")).hexdigest()
+
+
+# Content hash and extent of every street segment in the street store, keyed by OBJECTID. The hash covers the
+# vertices, the part breaks, STREET_LEVEL and SPEED_LIMIT, so the streets are not read from the layer again.
+def hash_streets(store):
+    street_hashes = {}
+    coords = store["coords"]
+    vertex_offsets = store["vertex_offsets"]
+    segment_starts = store["segment_starts"]
+    segment_offsets = store["segment_offsets"]
+    for position, street_id in enumerate(store["ids"].tolist()):
+        vertex_start = vertex_offsets[position]
+        digest = hashlib.sha1(coords[vertex_start:vertex_offsets[position + 1]].tobytes())
+        digest.update((segment_starts[segment_offsets[position]:segment_offsets[position + 1]] - vertex_start).tobytes())
+        digest.update(repr((store["levels"][position], store["speeds"][position])).encode("utf-8"))
+        street_hashes[str(street_id)] = [digest.hexdigest(), store["bounds"][position].tolist()]
+    return street_hashes
+
+
+# Crash attribute fields copied from the input layer (fields written by this script are left out)
+def get_crash_fields(crashes_fc):
+    return [
+        f.name for f in arcpy.ListFields(crashes_fc)
+        if f.type not in ("OID", "Geometry")
+        and f.name not in ("Near_Intersection", "Assigned_Speed_Limit", "DB_Speed_Limit", "Shape_Length", "Shape_Area")
+    ]
+
+
+# Content hash of every crash (geometry and attributes), keyed by Crash_Id
+def hash_crashes(crashes_fc, crash_fields):
+    crash_hashes = {}
+    crash_id_index = crash_fields.index("Crash_Id") + 1
+    with stage_metrics.opened(arcpy.da.SearchCursor(crashes_fc, ["SHAPE@WKB"] + crash_fields)) as cursor:
+        for row in cursor:
+            shape_wkb = bytes(row[0]) if row[0] is not None else None
+            crash_hashes[str(row[crash_id_index])] = hash_values((shape_wkb,) + tuple(row[1:]))
+    return crash_hashes
 
-    arcpy.analysis.Intersect([streets_fc], intersection_points, output_type="POINT")
 
-    # Add street level information to intersections
-    arcpy.management.AddField(intersection_points, "Street_Levels", "TEXT")
-    with arcpy.da.UpdateCursor(intersection_points, ["Street_Levels", "SHAPE@"]) as cursor:
+# Bring the existing crash copy in line with the input layer: drop removed crashes, refresh edited ones and add new ones
+def sync_crash_copy(crashes_fc, output_copy_fc, crash_fields, changed_ids, removed_ids):
+    crash_id_index = crash_fields.index("Crash_Id") + 1
+    source_rows = {}
+    with stage_metrics.opened(arcpy.da.SearchCursor(crashes_fc, ["SHAPE@"] + crash_fields)) as cursor:
         for row in cursor:
-            intersecting_levels = set()
-            with arcpy.da.SearchCursor(streets_fc, ["STREET_LEVEL", "SHAPE@"]) as street_cursor:
-                for street_row in street_cursor:
-                    if street_row[1].crosses(row[1]) and street_row[0] in [1, 2, 3, 4, 5]:
-                        intersecting_levels.add(street_row[0])
-            if intersecting_levels:
-                row[0] = ",".join(map(str, intersecting_levels))
-                cursor.updateRow(row)
-            else:
-                row[0] = "Default"
-                cursor.updateRow(row)
+            if str(row[crash_id_index]) in changed_ids:
+                source_rows[str(row[crash_id_index])] = row
 
-    # Create buffers around intersection points with initial default size
-    arcpy.management.CreateFeatureclass(project_gdb, "Customized_Buffers", "POLYGON", spatial_reference=intersections_fc)
-    arcpy.management.AddField(buffer_fc, "Buffer_Size", "TEXT")
-    arcpy.management.AddField(buffer_fc, "Street_Levels", "TEXT")
+    with stage_metrics.opened(arcpy.da.UpdateCursor(output_copy_fc, ["SHAPE@"] + crash_fields)) as cursor:
+        for row in cursor:
+            crash_key = str(row[crash_id_index])
+            if crash_key in removed_ids:
+                cursor.deleteRow()
+            elif crash_key in source_rows:
+                cursor.updateRow(list(source_rows.pop(crash_key)))
+
+    with stage_metrics.opened(arcpy.da.InsertCursor(output_copy_fc, ["SHAPE@"] + crash_fields)) as cursor:
+        for row in source_rows.values():
+            cursor.insertRow(row)
+
+
+# True when a changed street segment is close enough to a crash to change its assignment.
+# A changed segment can move buffers up to twice the largest buffer size away, or become the new nearest street.
+def is_near_changed_streets(x, y, previous_distance, changed_street_extents):
+    if not changed_street_extents:
+        return False
+    if previous_distance is None:
+        return True
+    reach = max(previous_distance, 2 * max_buffer_distance)
+    for x_min, y_min, x_max, y_max in changed_street_extents:
+        dx = max(x_min - x, 0, x - x_max)
+        dy = max(y_min - y, 0, y - y_max)
+        if math.hypot(dx, dy) <= reach:
+            return True
+    return False
+
+
+# Steps of a run recorded in the checkpoint, in order
+checkpoint_steps = ["crash_copy", "buffers", "crash_assignment", "db_fetch"]
+
+
+# Key of the streets, crashes and rules of a run; a checkpoint is only resumed by a run with the same key
+def run_key(street_hashes, crash_hashes):
+    digest = hashlib.sha1(repr((buffer_distances, incremental_mode)).encode("utf-8"))
+    for street_key in sorted(street_hashes):
+        digest.update(f"{street_key}:{street_hashes[street_key][0]};".encode("utf-8"))
+    for crash_key in sorted(crash_hashes):
+        digest.update(f"{crash_key}:{crash_hashes[crash_key]};".encode("utf-8"))
+    return digest.hexdigest()
+
+
+# Checkpoint of an interrupted run with the same key, or a fresh one. The file is a header line with the run key and
+# one line per save with the counters and what changed since the save before; the lines are merged in order.
+def load_checkpoint(key):
+    checkpoint = {
+        "run_key": key,
+        "step": None,
+        "last_object_id": None,
+        "processed_count": 0,
+        "skipped_count": 0,
+        "assignment_results": {},
+        "crash_state": {},
+        "speed_limit_dict": None,
+    }
+    if not checkpoint_file or not os.path.exists(checkpoint_file):
+        return checkpoint
+
+    with open(checkpoint_file) as f:
+        lines = f.read().splitlines()
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            # A save cut off by the interruption; the saves before it are complete
+            break
+    if not records or records[0].get("run_key") != key:
+        print(f"{checkpoint_file} is from other inputs or rules; starting over.")
+        os.remove(checkpoint_file)
+        return checkpoint
+    if len(records) < len(lines):
+        with open(checkpoint_file, "w") as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+
+    for record in records[1:]:
+        # JSON object keys are strings; the result table is keyed by OBJECTID
+        checkpoint["assignment_results"].update(
+            (int(object_id), result) for object_id, result in record.pop("assignment_results", {}).items())
+        checkpoint["crash_state"].update(record.pop("crash_state", {}))
+        checkpoint.update(record)
+    print(f"Resuming from {checkpoint_file}: last finished step {checkpoint['step']}, "
+          f"last assigned OBJECTID {checkpoint['last_object_id']}.")
+    return checkpoint
+
+
+# True when the checkpoint says the step (or a later one) finished
+def step_done(checkpoint, step):
+    return checkpoint["step"] is not None and checkpoint_steps.index(checkpoint["step"]) >= checkpoint_steps.index(step)
+
+
+# Save the checkpoint (after a finished step, when given): one line with the counters and the given changes is
+# appended, so every save writes only what is new and not the results of the whole run again. unsaved_crashes lists
+# the (OBJECTID, crash key) of the crashes assigned since the last save and is cleared.
+def save_checkpoint(checkpoint, step=None, unsaved_crashes=None, **changes):
+    if step is not None:
+        checkpoint["step"] = step
+    if not checkpoint_file:
+        return
+    record = {key: checkpoint[key] for key in ("step", "last_object_id", "processed_count", "skipped_count")}
+    if unsaved_crashes:
+        assignment_results = checkpoint["assignment_results"]
+        record["assignment_results"] = {
+            object_id: assignment_results[object_id] for object_id, _ in unsaved_crashes if object_id in assignment_results
+        }
+        record["crash_state"] = {crash_key: checkpoint["crash_state"][crash_key] for _, crash_key in unsaved_crashes}
+        unsaved_crashes.clear()
+    record.update(changes)
+    new_file = not os.path.exists(checkpoint_file)
+    with open(checkpoint_file, "a") as f:
+        if new_file:
+            f.write(json.dumps({"run_key": checkpoint["run_key"]}) + "\n")
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
 
-    buffer_creation_count = 0
+try:
+    # Read the streets once into the array store used by change detection, the buffer stages and the nearest-street index
+    stage = start_stage("street_loading")
+    streets = load_street_store(streets_fc)
+    end_stage(stage, len(streets["ids"]))
+
+    # Load the state of the last run and hash the current streets and crashes. Only incremental runs and checkpoints
+    # use the hashes, so without them the layers are not read for hashing and the crash state keeps None as the hash.
+    # A dry run has neither and never hashes: the full-layer passes would dominate the few seconds it should take.
+    previous_state = None
+    street_hashes = {}
+    crash_hashes = {}
+    crash_fields = get_crash_fields(crashes_fc)
+    rebuild_buffers = True
+    changed_street_extents = []
+    if (incremental_mode or checkpoint_file) and not dry_run_mode:
+        stage = start_stage("change_detection")
+        if incremental_mode and os.path.exists(state_file):
+            with open(state_file) as f:
+                previous_state = json.load(f)
+            print(f"Loaded incremental state from {state_file}")
+            if previous_state.get("buffer_distances") != buffer_distances:
+                print("Buffer size rules changed since the last run; running a full assignment.")
+                previous_state = None
+
+        street_hashes = hash_streets(streets)
+        crash_hashes = hash_crashes(crashes_fc, crash_fields)
+
+        if previous_state is not None:
+            previous_street_hashes = previous_state["street_hashes"]
+            for street_key in set(previous_street_hashes) | set(street_hashes):
+                previous_street = previous_street_hashes.get(street_key)
+                current_street = street_hashes.get(street_key)
+                if previous_street is None or current_street is None or previous_street[0] != current_street[0]:
+                    for street in (previous_street, current_street):
+                        if street is not None and street[1] is not None:
+                            changed_street_extents.append(street[1])
+            rebuild_buffers = bool(changed_street_extents) or not arcpy.Exists(buffer_fc)
+            print(f"Street segments changed since the last run: {len(changed_street_extents)} extents.")
+        end_stage(stage, len(street_hashes) + len(crash_hashes))
+
+    # Resume an interrupted run on the same inputs
+    checkpoint = load_checkpoint(run_key(street_hashes, crash_hashes))
+    if step_done(checkpoint, "buffers") and arcpy.Exists(buffer_fc):
+        rebuild_buffers = False
+
+    # Add field to flag crashes near intersections (the dry run leaves the input layer untouched)
+    if not dry_run_mode and "Near_Intersection" not in [f.name for f in arcpy.ListFields(crashes_fc)]:
+        arcpy.management.AddField(crashes_fc, "Near_Intersection", "SHORT")
+        print("Near_Intersection field added successfully.")
 
-    with arcpy.da.InsertCursor(buffer_fc, ["SHAPE@", "Buffer_Size", "Street_Levels"]) as buffer_cursor:
-        with arcpy.da.SearchCursor(intersection_points, ["SHAPE@", "Street_Levels"]) as cursor:
+    # Draw the dry run sample (not part of a full run, so left out of the estimate)
+    if dry_run_mode:
+        stage = start_stage("sampling")
+        with stage_metrics.opened(arcpy.da.SearchCursor(crashes_fc, ["OID@", "SHAPE@XY"])) as cursor:
+            crash_points = [(row[0], row[1][0], row[1][1]) for row in cursor if row[1][0] is not None]
+        sample_ids = dry_run.stratified_sample(crash_points, dry_run_sample_size, dry_run_strata, dry_run_seed)
+        dry_run_scale = {"crashes": len(crash_points) / max(len(sample_ids), 1)}
+        end_stage(stage, len(sample_ids))
+
+    # Create a copy of the crashes feature class, or bring the existing copy up to date in incremental mode
+    stage = start_stage("crash_copy", len(crash_hashes) or None)
+    crashes_to_assign = None
+    if previous_state is not None and arcpy.Exists(output_copy_fc):
+        previous_crashes = previous_state["crashes"]
+        crashes_to_assign = {
+            crash_key for crash_key, crash_hash in crash_hashes.items()
+            if crash_key not in previous_crashes or previous_crashes[crash_key][0] != crash_hash
+        }
+        removed_crashes = set(previous_crashes) - set(crash_hashes)
+        if step_done(checkpoint, "crash_copy"):
+            print(f"Resuming: {output_copy_fc} was already updated.")
+        else:
+            sync_crash_copy(crashes_fc, output_copy_fc, crash_fields, crashes_to_assign, removed_crashes)
+            print(f"Updated {output_copy_fc}: {len(crashes_to_assign)} new or changed crashes, {len(removed_crashes)} removed.")
+    elif step_done(checkpoint, "crash_copy") and arcpy.Exists(output_copy_fc):
+        print(f"Resuming: keeping the copy {output_copy_fc}")
+    elif not geodatabase_copy:
+        print(f"No geodatabase copy; reading the crashes from {crashes_fc}")
+    else:
+        if arcpy.Exists(output_copy_fc):
+            arcpy.management.Delete(output_copy_fc)
+            print(f"Deleted existing {output_copy_fc}")
+
+        if dry_run_mode:
+            # Copy only the sampled crashes to the scratch geodatabase
+            oid_field = arcpy.Describe(crashes_fc).OIDFieldName
+            arcpy.analysis.Select(crashes_fc, output_copy_fc, f"{oid_field} IN ({','.join(map(str, sample_ids))})")
+            print(f"Dry run: copied a sample of {len(sample_ids)} of {len(crash_points)} crashes to {output_copy_fc}")
+        else:
+            arcpy.management.Copy(crashes_fc, output_copy_fc)
+            print(f"Copied crashes to {output_copy_fc}")
+    save_checkpoint(checkpoint, "crash_copy")
+    end_stage(stage)
+
+    if rebuild_buffers:
+        # Remove existing feature class if it exists in the project geodatabase
+        if arcpy.Exists(buffer_fc):
+            arcpy.management.Delete(buffer_fc)
+            print(f"Deleted existing {buffer_fc}")
+
+        # Identify intersection points with street levels
+        stage = start_stage("intersection_points")
+        intersection_points = os.path.join(temp_gdb, "Intersection_Points")
+        if arcpy.Exists(intersection_points):
+            arcpy.management.Delete(intersection_points)
+            print(f"Deleted existing {intersection_points}")
+
+        if native_intersection_nodes:
+            # One point per node, with the street level bitmask and OBJECTIDs of its incident segments
+            nodes = intersection_nodes.extract_intersection_nodes(streets, node_snap_tolerance)
+            arcpy.management.CreateFeatureclass(temp_gdb, "Intersection_Points", "POINT", spatial_reference=streets_fc)
+            arcpy.management.AddField(intersection_points, "Street_Level_Mask", "LONG")
+            arcpy.management.AddField(intersection_points, "Segment_IDs", "TEXT", field_length=2000)
+            incident_offsets = nodes["incident_offsets"]
+            with stage_metrics.opened(arcpy.da.InsertCursor(intersection_points, ["SHAPE@XY", "Street_Level_Mask", "Segment_IDs"])) as cursor:
+                for node, (x, y) in enumerate(nodes["coords"].tolist()):
+                    segment_ids = nodes["incident_ids"][incident_offsets[node]:incident_offsets[node + 1]]
+                    cursor.insertRow([(x, y), int(nodes["level_masks"][node]), ",".join(map(str, segment_ids.tolist()))])
+        else:
+            arcpy.analysis.Intersect([streets_fc], intersection_points, output_type="POINT")
+        intersection_count = int(arcpy.management.GetCount(intersection_points)[0])
+
+        if dry_run_mode:
+            # Only the intersections whose largest possible buffer can reach a sampled crash matter for the sample
+            sample_points = os.path.join(temp_gdb, "Intersection_Points_Dry_Run")
+            if arcpy.Exists(sample_points):
+                arcpy.management.Delete(sample_points)
+            intersection_layer = arcpy.management.MakeFeatureLayer(intersection_points, "Dry_Run_Intersections")
+            arcpy.management.SelectLayerByLocation(intersection_layer, "WITHIN_A_DISTANCE", output_copy_fc,
+                                                   f"{max_buffer_distance} {buffer_unit}")
+            arcpy.management.CopyFeatures(intersection_layer, sample_points)
+            arcpy.management.Delete(intersection_layer)
+            intersection_points = sample_points
+            sampled_intersections = int(arcpy.management.GetCount(intersection_points)[0])
+            dry_run_scale["intersections"] = intersection_count / max(sampled_intersections, 1)
+            print(f"Dry run: buffering {sampled_intersections} of {intersection_count} intersections near the sample.")
+        end_stage(stage, intersection_count)
+
+        stage = start_stage("street_candidates")
+
+        # Find the streets within the largest buffer size of each intersection with one indexed spatial join.
+        # Any street crossing an intersection or one of its buffers is among these candidates.
+        street_candidates_fc = os.path.join(temp_gdb, "Intersection_Street_Candidates")
+        if arcpy.Exists(street_candidates_fc):
+            arcpy.management.Delete(street_candidates_fc)
+            print(f"Deleted existing {street_candidates_fc}")
+
+        arcpy.analysis.SpatialJoin(intersection_points, streets_fc, street_candidates_fc,
+                                   "JOIN_ONE_TO_MANY", "KEEP_COMMON",
+                                   match_option="WITHIN_A_DISTANCE",
+                                   search_radius=f"{max_buffer_distance} {buffer_unit}")
+
+        street_candidates = {}
+        with stage_metrics.opened(arcpy.da.SearchCursor(street_candidates_fc, ["TARGET_FID", "JOIN_FID"])) as cursor:
             for row in cursor:
-                street_levels_str = row[1].split(",")
+                street_candidates.setdefault(row[0], []).append(row[1])
+
+        print(f"Street candidates found for {len(street_candidates)} intersections.")
+        end_stage(stage, len(street_candidates))
+
+        # Add street level information to intersections
+        stage = start_stage("intersection_tagging", int(arcpy.management.GetCount(intersection_points)[0]))
+        arcpy.management.AddField(intersection_points, "Street_Levels", "TEXT")
+        intersection_centers = {}
+        # Incident segment OBJECTIDs of each extracted node; Intersect points have none
+        incident_segments = {}
+        tagging_fields = ["Street_Levels", "SHAPE@XY", "OID@"] + (["Segment_IDs"] if native_intersection_nodes else [])
+        with stage_metrics.opened(arcpy.da.UpdateCursor(intersection_points, tagging_fields)) as cursor:
+            for row in cursor:
+                x, y = row[1]
+                intersection_centers[row[2]] = (x, y)
+                if native_intersection_nodes and row[3]:
+                    incident_segments[row[2]] = {int(oid) for oid in row[3].split(",")}
+                intersecting_levels = buffer_street_levels(streets, incident_segments.get(row[2], set()),
+                                                           street_candidates.get(row[2], []), x, y, 0.0)
+                if intersecting_levels:
+                    row[0] = ",".join(map(str, intersecting_levels))
+                    cursor.updateRow(row)
+                else:
+                    row[0] = "Default"
+                    cursor.updateRow(row)
+        end_stage(stage, stage["rows_in"])
+
+        # Size the buffers around intersection points from their street levels. Buffers are circles, so only the
+        # radius is kept; no polygon is built or buffered again during the recalculation.
+        stage = start_stage("buffer_creation")
+        buffer_rows = []
+        with stage_metrics.opened(arcpy.da.SearchCursor(intersection_points, ["Street_Levels", "OID@"])) as cursor:
+            for row in cursor:
+                street_levels_str = row[0].split(",")
                 if all(level_str.isdigit() for level_str in street_levels_str) and street_levels_str != ['']:
-                    street_levels = list(map(int, street_levels_str))
-                    buffer_size = get_buffer_size(street_levels)
-                    buffer_geometry = row[0].buffer(float(buffer_size.split()[0]))
-                    buffer_cursor.insertRow([buffer_geometry, buffer_size, row[1]])
-                    buffer_creation_count += 1
+                    street_levels_mask = levels_to_mask(map(int, street_levels_str))
                 else:
-                    buffer_size = default_buffer_size
-                    buffer_geometry = row[0].buffer(float(buffer_size.split()[0]))
-                    buffer_cursor.insertRow([buffer_geometry, buffer_size, row[1]])
-                    buffer_creation_count += 1
-
-    print(f"Buffers around intersections created successfully: {buffer_creation_count} buffers created.")
-
-    # Recalculate buffer sizes based on street levels crossing the initial buffers
-    buffer_update_count = 0
-
-    with arcpy.da.UpdateCursor(buffer_fc, ["SHAPE@", "Buffer_Size", "Street_Levels"]) as buffer_cursor:
-        for row in buffer_cursor:
-            intersecting_levels = set()
-            with arcpy.da.SearchCursor(streets_fc, ["STREET_LEVEL", "SHAPE@"]) as street_cursor:
-                for street_row in street_cursor:
-                    if street_row[1].crosses(row[0]) and street_row[0] in [1, 2, 3, 4, 5]:
-                        intersecting_levels.add(street_row[0])
+                    street_levels_mask = 0  # Default size
+                # [Intersection_FID, buffer distance, Street_Levels, Max_Speed_Limit]
+                buffer_rows.append([row[1], buffer_distances[street_levels_mask], row[0], None])
+        buffer_creation_count = len(buffer_rows)
+
+        print(f"Buffers around intersections created successfully: {buffer_creation_count} buffers created.")
+        end_stage(stage, buffer_creation_count)
+
+        # Recalculate buffer sizes based on the street levels of the initial buffers,
+        # and store the highest speed limit of the streets of each final buffer
+        stage = start_stage("buffer_recalculation", buffer_creation_count)
+        buffer_update_count = 0
+        for buffer_row in buffer_rows:
+            candidate_oids = street_candidates.get(buffer_row[0], [])
+            x, y = intersection_centers[buffer_row[0]]
+            incident_oids = incident_segments.get(buffer_row[0], set())
+            intersecting_levels = buffer_street_levels(streets, incident_oids, candidate_oids, x, y, buffer_row[1])
             if intersecting_levels:
-                buffer_size = get_buffer_size(list(intersecting_levels))
-                buffer_geometry = row[0].buffer(float(buffer_size.split()[0]) - float(row[1].split()[0]))
-                row[0] = buffer_geometry
-                row[1] = buffer_size
-                row[2] = ",".join(map(str, intersecting_levels))
-                buffer_cursor.updateRow(row)
+                buffer_row[1] = buffer_distances[levels_to_mask(intersecting_levels)]
+                buffer_row[2] = ",".join(map(str, intersecting_levels))
                 buffer_update_count += 1
-
-    print(f"Buffers around intersections updated successfully: {buffer_update_count} buffers updated.")
-
-    # Create a copy of the crashes feature class
-    if arcpy.Exists(output_copy_fc):
-        arcpy.management.Delete(output_copy_fc)
-        print(f"Deleted existing {output_copy_fc}")
-
-    arcpy.management.Copy(crashes_fc, output_copy_fc)
-    print(f"Copied crashes to {output_copy_fc}")
-
-    # Add Assigned_Speed_Limit field if not exists
-    if "Assigned_Speed_Limit" not in [f.name for f in arcpy.ListFields(output_copy_fc)]:
-        arcpy.management.AddField(output_copy_fc, "Assigned_Speed_Limit", "SHORT")
-        print("Assigned_Speed_Limit field added successfully.")
-    else:
-        print("Assigned_Speed_Limit field already exists.")
-
-    # Add a field for the speed limit from the database if not exists
-    if "DB_Speed_Limit" not in [f.name for f in arcpy.ListFields(output_copy_fc)]:
-        arcpy.management.AddField(output_copy_fc, "DB_Speed_Limit", "SHORT")
-        print("DB_Speed_Limit field added successfully.")
+            buffer_row[3] = buffer_max_speed_limit(streets, incident_oids, candidate_oids, x, y, buffer_row[1])
+
+        print(f"Buffers around intersections updated successfully: {buffer_update_count} buffers updated.")
+        end_stage(stage, buffer_update_count)
+
+        # Write the buffers: circle polygons for map display, or only their centers
+        stage = start_stage("buffer_writing", buffer_creation_count)
+        arcpy.management.CreateFeatureclass(os.path.dirname(buffer_fc), os.path.basename(buffer_fc),
+                                            "POLYGON" if buffer_polygons else "POINT", spatial_reference=intersections_fc)
+        arcpy.management.AddField(buffer_fc, "Buffer_Size", "TEXT")
+        arcpy.management.AddField(buffer_fc, "Street_Levels", "TEXT")
+        arcpy.management.AddField(buffer_fc, "Intersection_FID", "LONG")
+        arcpy.management.AddField(buffer_fc, "Max_Speed_Limit", "SHORT")
+        spatial_reference = arcpy.Describe(buffer_fc).spatialReference
+        with stage_metrics.opened(arcpy.da.InsertCursor(buffer_fc, ["SHAPE@", "Buffer_Size", "Street_Levels", "Intersection_FID", "Max_Speed_Limit"])) as buffer_cursor:
+            for intersection_fid, buffer_distance, street_levels, max_speed_limit in buffer_rows:
+                center = arcpy.PointGeometry(arcpy.Point(*intersection_centers[intersection_fid]), spatial_reference)
+                buffer_cursor.insertRow([center.buffer(buffer_distance) if buffer_polygons else center,
+                                         buffer_size_text(buffer_distance, buffer_unit), street_levels,
+                                         intersection_fid, max_speed_limit])
+        end_stage(stage, buffer_creation_count)
+        save_checkpoint(checkpoint, "buffers")
     else:
-        print("DB_Speed_Limit field already exists.")
-
-    # Load buffer shapes
-    buffer_shapes = [row[0] for row in arcpy.da.SearchCursor(buffer_fc, ["SHAPE@"])]
-
-    crash_count = int(arcpy.management.GetCount(output_copy_fc)[0])
-    processed_count = 0
-
-    with arcpy.da.UpdateCursor(output_copy_fc, ["OBJECTID", "SHAPE@", "Assigned_Speed_Limit", "Near_Intersection", "Crash_Id", "DB_Speed_Limit"]) as cursor:
+        print(f"Street network unchanged; reusing {buffer_fc}")
+
+    # Result fields of the copy (the dry run sample is a fresh copy of the input layer, which has no
+    # Near_Intersection field yet)
+    if geodatabase_copy:
+        if "Near_Intersection" not in [f.name for f in arcpy.ListFields(output_copy_fc)]:
+            arcpy.management.AddField(output_copy_fc, "Near_Intersection", "SHORT")
+
+        # Add Assigned_Speed_Limit field if not exists
+        if "Assigned_Speed_Limit" not in [f.name for f in arcpy.ListFields(output_copy_fc)]:
+            arcpy.management.AddField(output_copy_fc, "Assigned_Speed_Limit", "SHORT")
+            print("Assigned_Speed_Limit field added successfully.")
+        else:
+            print("Assigned_Speed_Limit field already exists.")
+
+        # Add a field for the speed limit from the database if not exists
+        if "DB_Speed_Limit" not in [f.name for f in arcpy.ListFields(output_copy_fc)]:
+            arcpy.management.AddField(output_copy_fc, "DB_Speed_Limit", "SHORT")
+            print("DB_Speed_Limit field added successfully.")
+        else:
+            print("DB_Speed_Limit field already exists.")
+
+    # Load the buffer circles (center and radius) with their highest speed limit. SHAPE@XY is the center of a
+    # buffer point and the centroid, i.e. also the center, of a buffer polygon.
+    stage = start_stage("index_loading")
+    buffer_circles = []
+    buffer_max_speeds = []
+    with stage_metrics.opened(arcpy.da.SearchCursor(buffer_fc, ["SHAPE@XY", "Buffer_Size", "Max_Speed_Limit"])) as buffer_cursor:
+        for row in buffer_cursor:
+            buffer_circles.append((row[0][0], row[0][1], parse_buffer_size(row[1])))
+            buffer_max_speeds.append(row[2])
+
+    buffer_index = build_buffer_index(buffer_circles)
+
+    # Load street segments into the nearest-street index
+    street_index = build_street_index(streets)
+    end_stage(stage, len(buffer_circles) + (len(street_index["store"]["ids"]) if street_index else 0))
+
+    # Start retrieving the speed limits for the crashes in the output feature class, overlapping the spatial work
+    with stage_metrics.opened(arcpy.da.SearchCursor(crash_source_fc, ["Crash_Id"])) as cursor:
+        local_crash_ids = [row[0] for row in cursor]
+    if not step_done(checkpoint, "db_fetch"):
+        db_future = fetch_db_speed_limits_async(connect_database, local_crash_ids, db_connections)
+
+    crash_count = int(arcpy.management.GetCount(crash_source_fc)[0])
+    processed_count = checkpoint["processed_count"]
+    skipped_count = checkpoint["skipped_count"]
+    crash_state = checkpoint["crash_state"]
+
+    # Compute the assignment first into a compact result table: OBJECTID -> [Near_Intersection, Assigned_Speed_Limit].
+    # The crash layer is only read here and written back once at the end. Crashes are read in OBJECTID order so that
+    # a resumed run can continue after the last OBJECTID in the checkpoint.
+    assignment_results = checkpoint["assignment_results"]
+    pending_nearest = []
+    unsaved_crashes = []
+    stage = start_stage("crash_assignment", crash_count)
+    where_clause = None
+    if step_done(checkpoint, "crash_assignment"):
+        # The checkpoint already holds the whole result table
+        where_clause = "1 = 0"
+    elif checkpoint["last_object_id"] is not None:
+        where_clause = f"OBJECTID > {checkpoint['last_object_id']}"
+
+    # Without the copy there is no earlier Assigned_Speed_Limit to start from
+    crash_cursor_fields = ["OBJECTID", "SHAPE@XY", "Crash_Id"] + (["Assigned_Speed_Limit"] if geodatabase_copy else [])
+    with stage_metrics.opened(arcpy.da.SearchCursor(crash_source_fc, crash_cursor_fields,
+                                                    where_clause, sql_clause=(None, "ORDER BY OBJECTID"))) as cursor:
         for row in cursor:
-            crash_id = row[4]  # Corrected index for Crash_Id in the cursor
-            point = row[1]
+            crash_id = row[2]
+            x, y = row[1]
+            crash_key = str(crash_id)
+
+            # In incremental mode keep the previous result unless the crash or the streets around it changed
+            if crashes_to_assign is not None and crash_key not in crashes_to_assign:
+                if not is_near_changed_streets(x, y, previous_crashes[crash_key][1], changed_street_extents):
+                    crash_state[crash_key] = previous_crashes[crash_key]
+                    unsaved_crashes.append((row[0], crash_key))
+                    skipped_count += 1
+                    processed_count += 1
+                    stage_metrics.progress(stage, processed_count, crash_count)
+                    continue
+            assigned_speed_limit = row[3] if geodatabase_copy and crashes_to_assign is None else None
 
             # Check if crash point is within any buffer
-            is_within_buffer = any(buffer_shape.contains(point) for buffer_shape in buffer_shapes)
-            row[3] = 1 if is_within_buffer else None
-
-            if row[3] == 1:
-                # Get the highest speed limit from intersecting street segments within the buffer
-                intersecting_speeds = []
-                for buffer_shape in buffer_shapes:
-                    if buffer_shape.contains(point):
-                        for street_row in arcpy.da.SearchCursor(streets_fc, ["SHAPE@", "SPEED_LIMIT"]):
-                            if street_row[0].crosses(buffer_shape) and street_row[1] is not None:
-                                intersecting_speeds.append(street_row[1])
+            containing_buffers = buffers_containing(buffer_index, buffer_circles, x, y)
+            near_intersection = 1 if containing_buffers else None
+
+            if near_intersection == 1:
+                # Overlapping buffers: the crash takes the highest Max_Speed_Limit of all buffers containing it
+                intersecting_speeds = [
+                    buffer_max_speeds[position]
+                    for position in containing_buffers
+                    if buffer_max_speeds[position] is not None
+                ]
                 if intersecting_speeds:
-                    row[2] = max(intersecting_speeds)
+                    assigned_speed_limit = max(intersecting_speeds)
+
+            assignment_results[row[0]] = [near_intersection, assigned_speed_limit]
+
+            if near_intersection == 1:
+                # Near-intersection crashes are recorded with distance 0 and no segment
+                crash_state[crash_key] = [crash_hashes.get(crash_key), 0.0, None]
             else:
-                # Find the nearest street segment
-                nearest_street = None
-                nearest_distance = float('inf')
-                with arcpy.da.SearchCursor(streets_fc, ["SHAPE@", "SPEED_LIMIT"]) as street_cursor:
-                    for street_row in street_cursor:
-                        street_line = street_row[0]
-                        speed_limit = street_row[1]
-                        distance = point.distanceTo(street_line)
-                        if distance < nearest_distance and speed_limit is not None:
-                            nearest_distance = distance
-                            nearest_street = speed_limit
-
-                # Assign the speed limit from the nearest street
-                if nearest_street is not None:
-                    row[2] = nearest_street
-
-            cursor.updateRow(row)
+                # Find the nearest street segment through the grid index, nearest_batch_size crashes at a time
+                pending_nearest.append((row[0], crash_key, x, y))
+                if len(pending_nearest) >= nearest_batch_size:
+                    assign_nearest_batch(street_index, pending_nearest, assignment_results, crash_state, crash_hashes)
 
             # Log progress
             processed_count += 1
-            if processed_count % 100 == 0:
-                print(f"Processed {processed_count}/{crash_count} crashes.")
-
+            unsaved_crashes.append((row[0], crash_key))
+            stage_metrics.progress(stage, processed_count, crash_count)
+
+            # Checkpoint the results up to this crash
+            if checkpoint_file and processed_count - checkpoint["processed_count"] >= checkpoint_every:
+                assign_nearest_batch(street_index, pending_nearest, assignment_results, crash_state, crash_hashes)
+                checkpoint.update({"last_object_id": row[0], "processed_count": processed_count, "skipped_count": skipped_count})
+                save_checkpoint(checkpoint, unsaved_crashes=unsaved_crashes)
+
+    assign_nearest_batch(street_index, pending_nearest, assignment_results, crash_state, crash_hashes)
+    checkpoint.update({"processed_count": processed_count, "skipped_count": skipped_count})
+    save_checkpoint(checkpoint, "crash_assignment", unsaved_crashes)
+    end_stage(stage, len(assignment_results))
+    if crashes_to_assign is not None:
+        print(f"Incremental run kept the previous result for {skipped_count} unchanged crashes.")
     print("Speed limit assignment complete.")
     print("Final assignment of crashes near intersections completed.")
 
-    # Connect to the PostgreSQL database and retrieve speed limits
-    conn = psycopg2.connect(
-        dbname="YOUR_DATABSE",
-        user="YOUR_USERNAME",
-        password="YOUR_PASSWORD",
-        host="YOUR_HOST"
-)
-    cursor = conn.cursor()
-    cursor.execute("SELECT crash_id, crash_speed_limit FROM public.atd_txdot_crashes")
-    db_speed_limits = cursor.fetchall()
+    # Wait for the database speed limits (only the part of the fetch not hidden behind the assignment is timed here)
+    stage = start_stage("db_fetch", len(local_crash_ids))
+    if step_done(checkpoint, "db_fetch"):
+        speed_limit_dict = checkpoint["speed_limit_dict"]
+    else:
+        speed_limit_dict = db_future.result()
+        checkpoint["speed_limit_dict"] = speed_limit_dict
+        save_checkpoint(checkpoint, "db_fetch", speed_limit_dict=speed_limit_dict)
+
+    # Report how many local crashes were found in the database
+    print(f"Speed limits retrieved from the database for {len(speed_limit_dict)} of {len(local_crash_ids)} crashes.")
+    end_stage(stage, len(speed_limit_dict))
+
+    if geodatabase_copy:
+        # Write Near_Intersection, Assigned_Speed_Limit and DB_Speed_Limit back in a single pass,
+        # touching only the rows whose values changed
+        stage = start_stage("write_back", len(assignment_results))
+        write_count = 0
+        with stage_metrics.opened(arcpy.da.UpdateCursor(output_copy_fc, ["OBJECTID", "Near_Intersection", "Assigned_Speed_Limit", "Crash_Id", "DB_Speed_Limit"])) as cursor:
+            for row in cursor:
+                new_row = list(row)
+                if row[0] in assignment_results:
+                    new_row[1], new_row[2] = assignment_results[row[0]]
+                crash_id = str(row[3])  # Ensure crash_id is a string for dictionary lookup
+                if crash_id in speed_limit_dict:
+                    new_row[4] = speed_limit_dict[crash_id]
+                if new_row != list(row):
+                    cursor.updateRow(new_row)
+                    write_count += 1
+        end_stage(stage, write_count)
 
-    # Create a dictionary from the database results
-    speed_limit_dict = {str(row[0]): row[1] for row in db_speed_limits}
+    print("Database speed limit assignment complete.")
 
-    # Debug print to verify dictionary content
-    print(f"Speed limit dictionary: {speed_limit_dict}")
+    # Write the columnar result table; with the copy its (just written) fields are the final values
+    if result_table_dir:
+        import result_table  # needs pyarrow, which only the result table requires
 
-    # Update the crash points with the speed limit from the database
-    with arcpy.da.UpdateCursor(output_copy_fc, ["Crash_Id", "DB_Speed_Limit"]) as cursor:
-        for row in cursor:
-            crash_id = str(row[0])  # Ensure crash_id is a string for dictionary lookup
-            if crash_id in speed_limit_dict:
-                row[1] = speed_limit_dict[crash_id]
-                cursor.updateRow(row)
+        stage = start_stage("result_table", crash_count)
+        result_fields = ["OBJECTID", "SHAPE@XY", "Crash_Id"] + (["Near_Intersection", "Assigned_Speed_Limit"] if geodatabase_copy else [])
+        crs = result_table.crs_projjson(arcpy.Describe(crash_source_fc).spatialReference.factoryCode)
+        with stage_metrics.opened(arcpy.da.SearchCursor(crash_source_fc, result_fields)) as cursor:
+            result_count = result_table.write_result_table(
+                (result_row(row, assignment_results, speed_limit_dict, crash_state) for row in cursor),
+                result_table_dir, result_table_part_rows, result_table_format, crs)
+        end_stage(stage, result_count)
 
-    print("Database speed limit assignment complete.")
+    # The run is complete; the next run starts from the beginning
+    if checkpoint_file and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+    if dry_run_mode:
+        dry_run.report(stage_records, dry_run_scale, assignment_results)
+
+    # Save the state of this run for the next incremental run
+    if incremental_mode:
+        with open(state_file, "w") as f:
+            json.dump({"street_hashes": street_hashes, "buffer_distances": buffer_distances, "crashes": crash_state}, f)
+        print(f"Incremental state saved to {state_file}")
 
 except arcpy.ExecuteError as e:
     print(f"Error: {e}")
@@ -244,11 +974,11 @@ except Exception as e:
     print(f"An unexpected error occurred: {e}")
     arcpy.AddError(e)
 finally:
+    if checkpoint_file and os.path.exists(checkpoint_file):
+        print(f"Progress is saved in {checkpoint_file}; run the script again to resume.")
+
     # Ensure the buffer feature class exists
     if arcpy.Exists(buffer_fc):
         print("Buffers around intersections retained successfully.")
     else:
         print("Buffers around intersections do not exist.")
-
-    if 'conn' in locals():
-        conn.close()
@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+import speed_limit_engine as engine
+from crash_db import fetch_db_speed_limits
+
+# Benchmark of the speed limit assignment stages on synthetic street networks and crash sets.
+# Results are written as JSON so runs of different versions can be compared with --baseline.
+
+# Typical posted speed (mph) for each street level
+level_speed_limits = {1: 25, 2: 30, 3: 35, 4: 45, 5: 55}
+level_weights = [0.45, 0.25, 0.15, 0.1, 0.05]
+null_speed_share = 0.02
+
+stage_names = [
+    "intersection_tagging",
+    "buffer_creation",
+    "buffer_recalculation",
+    "within_buffer_test",
+    "nearest_street",
+    "db_join",
+]
+
+
+# Street levels and speed limits drawn for n segments (a few speed limits are NULL, like in the CTN)
+def street_attributes(rng, n):
+    levels = rng.choice([1, 2, 3, 4, 5], size=n, p=level_weights)
+    speeds = np.array([level_speed_limits[level] for level in levels], dtype=float)
+    speeds[rng.random(n) < null_speed_share] = np.nan
+    return levels, speeds
+
+
+# Square grid of blocks with the given spacing (feet); every grid node is an intersection
+def grid_network(rng, n_streets, spacing=300.0):
+    side = max(int(np.sqrt(n_streets / 2)), 2)
+    nodes = np.array([(i * spacing, j * spacing) for i in range(side + 1) for j in range(side + 1)])
+    lines = []
+    for i in range(side + 1):
+        for j in range(side):
+            lines.append([(i * spacing, j * spacing), (i * spacing, (j + 1) * spacing)])
+            lines.append([(j * spacing, i * spacing), ((j + 1) * spacing, i * spacing)])
+    return nodes, shapely.linestrings(np.array(lines))
+
+
+# Irregular network from the Delaunay edges of random nodes, with long edges dropped
+def organic_network(rng, n_streets, spacing=300.0):
+    n_nodes = max(n_streets // 3, 4)
+    side = spacing * np.sqrt(n_nodes)
+    nodes = rng.random((n_nodes, 2)) * side
+    edges = shapely.get_parts(shapely.delaunay_triangles(shapely.multipoints(nodes), only_edges=True))
+    edges = edges[shapely.length(edges) < 2 * spacing]
+    return nodes, edges
+
+
+# Crashes clustered around intersections plus crashes spread along the streets
+def clustered_crashes(rng, nodes, lines, n_crashes, cluster_share=0.4, spread=40.0):
+    n_clustered = int(n_crashes * cluster_share)
+    centers = nodes[rng.integers(0, len(nodes), n_clustered)]
+    clustered = centers + rng.normal(0, spread, (n_clustered, 2))
+
+    n_along = n_crashes - n_clustered
+    along_lines = lines[rng.integers(0, len(lines), n_along)]
+    along = shapely.line_interpolate_point(along_lines, rng.random(n_along), normalized=True)
+    along = shapely.get_coordinates(along) + rng.normal(0, spread / 2, (n_along, 2))
+    return shapely.points(np.vstack([clustered, along]))
+
+
+# Synthetic streets, intersections and crashes as GeoDataFrames
+def synthetic_inputs(network, n_streets, n_crashes, seed=0):
+    rng = np.random.default_rng(seed)
+    nodes, lines = grid_network(rng, n_streets) if network == "grid" else organic_network(rng, n_streets)
+    levels, speeds = street_attributes(rng, len(lines))
+    streets = gpd.GeoDataFrame({"STREET_LEVEL": levels, "SPEED_LIMIT": speeds}, geometry=lines, crs=2277)
+    intersections = gpd.GeoDataFrame(geometry=shapely.points(nodes), crs=2277)
+    crashes = gpd.GeoDataFrame(
+        {"Crash_Id": np.arange(1, n_crashes + 1)},
+        geometry=clustered_crashes(rng, nodes, lines, n_crashes),
+        crs=2277,
+    )
+    return streets, intersections, crashes
+
+
+# Local stand-in for the crash table with CR3 speed limits (NULL and -1 where not reported)
+def crash_database(crash_ids, seed=0):
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE atd_txdot_crashes (crash_id INTEGER PRIMARY KEY, crash_speed_limit INTEGER)")
+    speeds = rng.choice([-1, 0, 25, 30, 35, 45, 55], size=len(crash_ids))
+    conn.executemany(
+        "INSERT INTO atd_txdot_crashes VALUES (?, ?)",
+        ((int(crash_id), None if speed == 0 else int(speed)) for crash_id, speed in zip(crash_ids, speeds)),
+    )
+    return conn
+
+
+# Run one stage and record wall time, throughput and (optionally) peak traced memory
+def timed_stage(stages, name, rows, trace_memory, function, *args):
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    stage = {"seconds": seconds, "rows": rows, "rows_per_second": rows / seconds if seconds > 0 else None}
+    if trace_memory:
+        stage["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    stages[name] = stage
+    print(f"  {name}: {seconds:.3f} s for {rows} rows")
+    return result
+
+
+# Time every stage of the final pipeline on one synthetic data set
+def run_benchmark(network, n_streets, n_crashes, trace_memory=False, seed=0):
+    streets, intersections, crashes = synthetic_inputs(network, n_streets, n_crashes, seed)
+    print(f"{network}: {len(streets)} streets, {len(intersections)} intersections, {len(crashes)} crashes")
+    points = intersections.geometry.values
+    crash_points = crashes.geometry.values
+    stages = {}
+
+    pairs = timed_stage(stages, "intersection_tagging", len(points), trace_memory,
+                        engine.node_street_pairs, intersections, streets, float(engine.buffer_table.max()))
+    initial_radius = timed_stage(stages, "buffer_creation", len(points), trace_memory,
+                                 engine.initial_buffer_radius, pairs, engine.buffer_table)
+    distances, _, max_speeds = timed_stage(stages, "buffer_recalculation", len(points), trace_memory,
+                                           engine.recalculate_buffer_radius, pairs, engine.buffer_table, initial_radius)
+
+    buffers = gpd.GeoDataFrame({"Buffer_Distance": distances, "Max_Speed_Limit": max_speeds},
+                               geometry=points, crs=streets.crs)
+    point_idx, _ = timed_stage(stages, "within_buffer_test", len(crash_points), trace_memory,
+                               engine.points_within_buffers, crash_points, buffers)
+    far = np.ones(len(crash_points), dtype=bool)
+    far[point_idx] = False
+    timed_stage(stages, "nearest_street", int(far.sum()), trace_memory,
+                engine.nearest_street_speed_limits, crash_points[far], streets)
+
+    conn = crash_database(crashes["Crash_Id"].to_numpy(), seed)
+    timed_stage(stages, "db_join", len(crashes), trace_memory,
+                fetch_db_speed_limits, conn, crashes["Crash_Id"].tolist(), "atd_txdot_crashes")
+    conn.close()
+
+    return {
+        "network": network,
+        "streets": len(streets),
+        "intersections": len(intersections),
+        "crashes": len(crashes),
+        "stages": stages,
+        "total_seconds": sum(stage["seconds"] for stage in stages.values()),
+        # ru_maxrss is in kilobytes on Linux
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Print the time ratio of every stage against a previous results file. Stages only one of the two runs has (renamed
+# or added between versions) are listed instead of being left out.
+def compare_with_baseline(results, baseline):
+    baseline_runs = {(run["network"], run["streets"], run["crashes"]): run for run in baseline["runs"]}
+    for run in results["runs"]:
+        previous = baseline_runs.get((run["network"], run["streets"], run["crashes"]))
+        if previous is None:
+            print(f"{run['network']} {run['streets']} streets / {run['crashes']} crashes: not in the baseline")
+            continue
+        print(f"{run['network']} {run['streets']} streets / {run['crashes']} crashes vs {baseline.get('revision')}:")
+        names = stage_names + [name for name in list(run["stages"]) + list(previous["stages"]) if name not in stage_names]
+        for name in dict.fromkeys(names):
+            if name not in previous["stages"]:
+                print(f"  {name}: not in the baseline")
+            elif name not in run["stages"]:
+                print(f"  {name}: only in the baseline")
+            elif previous["stages"][name]["seconds"] > 0:
+                ratio = run["stages"][name]["seconds"] / previous["stages"][name]["seconds"]
+                print(f"  {name}: {ratio:.2f}x {'(slower)' if ratio > 1.1 else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the speed limit assignment stages on synthetic data.")
+    parser.add_argument("--networks", nargs="+", default=["grid", "organic"], choices=["grid", "organic"])
+    parser.add_argument("--streets", type=int, default=20000, help="Approximate number of street segments")
+    parser.add_argument("--crashes", type=int, nargs="+", default=[10000, 100000], help="Crash set sizes (10k to 1M)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true", help="Record peak traced memory per stage (slower)")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="Earlier results file to compare against")
+    args = parser.parse_args()
+
+    results = {
+        "revision": git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "shapely": shapely.__version__,
+        "geopandas": gpd.__version__,
+        "runs": [],
+    }
+    for network in args.networks:
+        for n_crashes in args.crashes:
+            results["runs"].append(run_benchmark(network, args.streets, n_crashes, args.trace_memory, args.seed))
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Benchmark results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_with_baseline(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
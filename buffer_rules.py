@@ -0,0 +1,95 @@
+import csv
+import os
+
+# Buffer size rules by street level combination, loaded from a CSV or YAML file and compiled into
+# a 32-entry lookup table indexed by a 5-bit street level mask (bit 0 = level 1, ..., bit 4 = level 5).
+#
+# CSV: columns street_levels, distance, unit; street_levels is a list such as "1,2,4" or "default".
+# YAML: {unit: Feet, default: 50, rules: {"1,2": 50, "1,4": 60, ...}}
+# Combinations that are not listed (single levels, no levels) get the default size.
+
+street_level_count = 5
+table_size = 1 << street_level_count
+
+rules_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules")
+default_rules_file = os.path.join(rules_dir, "buffer_sizes_final.csv")
+
+
+# 5-bit mask of a collection of street levels (1-5)
+def levels_to_mask(levels):
+    mask = 0
+    for level in levels:
+        mask |= 1 << (int(level) - 1)
+    return mask
+
+
+# Street levels set in a mask, in ascending order
+def mask_to_levels(mask):
+    return [level for level in range(1, street_level_count + 1) if mask & (1 << (level - 1))]
+
+
+# Street_Levels text as written to the buffers ("1,3,4"), "Default" for no levels
+def mask_to_text(mask):
+    return ",".join(map(str, mask_to_levels(mask))) if mask else "Default"
+
+
+# Buffer_Size text as written to the buffers, e.g. "50 Feet"
+def buffer_size_text(distance, unit):
+    return f"{distance:g} {unit}"
+
+
+# Distance of a Buffer_Size text such as "50 Feet"
+def parse_buffer_size(buffer_size):
+    return float(buffer_size.split()[0])
+
+
+def parse_street_levels(street_levels, path):
+    levels = [int(level) for level in str(street_levels).replace(" ", "").split(",") if level]
+    if not levels or any(level < 1 or level > street_level_count for level in levels):
+        raise ValueError(f"Invalid street levels {street_levels!r} in {path}; expected levels 1-{street_level_count}.")
+    return levels
+
+
+# Read a rule file into {"unit": ..., "default": distance, "rules": {mask: distance}}
+def load_buffer_rules(path):
+    if os.path.splitext(path)[1].lower() in (".yaml", ".yml"):
+        import yaml
+
+        with open(path) as f:
+            config = yaml.safe_load(f)
+        unit = config.get("unit", "Feet")
+        default = float(config["default"])
+        entries = [(street_levels, distance, unit) for street_levels, distance in config.get("rules", {}).items()]
+    else:
+        with open(path, newline="") as f:
+            rows = list(csv.DictReader(f))
+        default_rows = [row for row in rows if row["street_levels"].strip().lower() == "default"]
+        if len(default_rows) != 1:
+            raise ValueError(f"{path} must have exactly one 'default' row.")
+        unit = default_rows[0]["unit"].strip()
+        default = float(default_rows[0]["distance"])
+        entries = [(row["street_levels"], row["distance"], row["unit"].strip()) for row in rows if row not in default_rows]
+
+    rules = {}
+    for street_levels, distance, entry_unit in entries:
+        if entry_unit != unit:
+            raise ValueError(f"Mixed units in {path}: {entry_unit!r} and {unit!r}.")
+        mask = levels_to_mask(parse_street_levels(street_levels, path))
+        if mask in rules:
+            raise ValueError(f"Street levels {street_levels!r} are listed twice in {path}.")
+        rules[mask] = float(distance)
+    return {"unit": unit, "default": default, "rules": rules}
+
+
+# 32-entry list of buffer distances indexed by street level mask
+def compile_buffer_rules(buffer_rules):
+    table = [buffer_rules["default"]] * table_size
+    for mask, distance in buffer_rules["rules"].items():
+        table[mask] = distance
+    return table
+
+
+# Compiled lookup table and unit for a rule file
+def load_buffer_table(path=default_rules_file):
+    buffer_rules = load_buffer_rules(path)
+    return compile_buffer_rules(buffer_rules), buffer_rules["unit"]
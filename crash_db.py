@@ -0,0 +1,120 @@
+import queue
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+# CR3 speed limits from the crash database, fetched only for the crashes we have locally.
+# Works with a psycopg2 connection to the AWS PostgreSQL database, or with a sqlite3 connection
+# to a local stand-in table with the same columns. NULL and -1 ("not reported" on the CR3 form) both come back as None.
+
+crashes_table = "public.atd_txdot_crashes"
+
+# Crash ids sent to the database per query, and rows read from the cursor at a time
+batch_size = 10000
+page_size = 2000
+
+
+# Crash ids are integers in the database; keep any id that is not a plain number as text
+def normalize_crash_id(crash_id):
+    crash_id_str = str(crash_id).strip()
+    return int(crash_id_str) if crash_id_str.isdigit() else crash_id_str
+
+
+# Split the crash ids into lists of at most batch_size ids
+def batched(crash_ids, size):
+    crash_ids = list(crash_ids)
+    for start in range(0, len(crash_ids), size):
+        yield crash_ids[start:start + size]
+
+
+# CR3 speed limits recorded when the officer did not report one; stored as NULL
+not_reported_speed_limits = (-1,)
+
+
+# Speed limit as written to DB_Speed_Limit: None when the CR3 form has no reported speed limit
+def normalize_speed_limit(speed_limit):
+    if speed_limit is None or speed_limit in not_reported_speed_limits:
+        return None
+    return speed_limit
+
+
+# Distinct normalized crash ids, in a stable order
+def unique_crash_ids(crash_ids):
+    return sorted({normalize_crash_id(crash_id) for crash_id in crash_ids if crash_id is not None}, key=str)
+
+
+# Fetch one batch of crash ids on an open connection into speed_limit_dict, page_size rows at a time.
+# On PostgreSQL a plain cursor receives the whole result in execute(), so a named (server-side) cursor keeps the rows
+# on the server and brings them over page_size at a time; sqlite3 cursors already step through the result.
+def fetch_batch(conn, crash_id_batch, speed_limit_dict, table=crashes_table, page_size=page_size):
+    server_side = not isinstance(conn, sqlite3.Connection)
+    if server_side:
+        cursor = conn.cursor(name="crash_speed_limits")
+        cursor.itersize = page_size
+    else:
+        cursor = conn.cursor()
+    try:
+        if server_side:
+            cursor.execute(
+                f"SELECT crash_id, crash_speed_limit FROM {table} WHERE crash_id = ANY(%s)",
+                (crash_id_batch,),
+            )
+        else:
+            placeholders = ",".join("?" * len(crash_id_batch))
+            cursor.execute(
+                f"SELECT crash_id, crash_speed_limit FROM {table} WHERE crash_id IN ({placeholders})",
+                crash_id_batch,
+            )
+        for row in cursor:
+            speed_limit_dict[str(row[0])] = normalize_speed_limit(row[1])
+    finally:
+        cursor.close()
+        # A server-side cursor lives in a transaction; end it so the connection does not stay idle in transaction
+        if server_side:
+            conn.rollback()
+
+
+# Dictionary of Crash_Id (as a string) to crash_speed_limit for the given crash ids only
+def fetch_db_speed_limits(conn, crash_ids, table=crashes_table, size=batch_size):
+    speed_limit_dict = {}
+    for crash_id_batch in batched(unique_crash_ids(crash_ids), size):
+        fetch_batch(conn, crash_id_batch, speed_limit_dict, table)
+    return speed_limit_dict
+
+
+# One pooled connection: take batches off the shared queue until it is empty
+def fetch_worker(connect, batches, table):
+    speed_limit_dict = {}
+    conn = connect()
+    try:
+        while True:
+            try:
+                crash_id_batch = batches.get_nowait()
+            except queue.Empty:
+                return speed_limit_dict
+            fetch_batch(conn, crash_id_batch, speed_limit_dict, table)
+    finally:
+        conn.close()
+
+
+# Run the workers and merge their pages by Crash_Id
+def fetch_with_pool(connect, batches, table, workers):
+    speed_limit_dict = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_worker, connect, batches, table) for _ in range(workers)]
+        for future in futures:
+            speed_limit_dict.update(future.result())
+    return speed_limit_dict
+
+
+# Start the same fetch as fetch_db_speed_limits in the background and return a Future of its dictionary.
+# connect() opens one database connection; up to workers connections fetch the batches concurrently,
+# so the database round trips overlap with whatever the caller does until it asks for future.result().
+def fetch_db_speed_limits_async(connect, crash_ids, workers=4, table=crashes_table, size=batch_size):
+    batches = queue.Queue()
+    for crash_id_batch in batched(unique_crash_ids(crash_ids), size):
+        batches.put(crash_id_batch)
+    workers = max(1, min(workers, batches.qsize()))
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(fetch_with_pool, connect, batches, table, workers)
+    executor.shutdown(wait=False)
+    return future
@@ -0,0 +1,113 @@
+import random
+from collections import Counter
+
+import stage_metrics
+
+# Planning helpers for the dry run of 04__Final_Code_01.py: a stratified crash sample, runtime extrapolation from the
+# measured stages and the expected assignment statistics.
+
+# What the cost of a stage grows with in a full run. Stages not listed are reported as measured: intersection points
+# and street loading already run on the full data in a dry run, and index loading is mostly the full street index.
+# A dry run skips change detection, which only incremental runs and checkpoints need.
+stage_scaling = {
+    "street_candidates": "intersections",
+    "intersection_tagging": "intersections",
+    "buffer_creation": "intersections",
+    "buffer_recalculation": "intersections",
+    "buffer_writing": "intersections",
+    "crash_copy": "crashes",
+    "crash_assignment": "crashes",
+    "db_fetch": "crashes",
+    "write_back": "crashes",
+    "result_table": "crashes",
+}
+
+# Stages that only exist in a dry run
+dry_run_stages = {"sampling"}
+
+
+# Random sample of about sample_size ids from [(id, x, y), ...], stratified over a strata x strata grid of the extent.
+# Every cell gets a share proportional to its crashes (largest remainder rounding), so dense downtown cells and
+# sparse outer cells are both represented and the sample needs no weights.
+def stratified_sample(points, sample_size, strata=10, seed=0):
+    if sample_size >= len(points):
+        return [point[0] for point in points]
+    x_min = min(point[1] for point in points)
+    y_min = min(point[2] for point in points)
+    width = (max(point[1] for point in points) - x_min) or 1.0
+    height = (max(point[2] for point in points) - y_min) or 1.0
+
+    cells = {}
+    for point_id, x, y in points:
+        col = min(int((x - x_min) / width * strata), strata - 1)
+        row = min(int((y - y_min) / height * strata), strata - 1)
+        cells.setdefault((col, row), []).append(point_id)
+
+    quotas = {cell: len(ids) * sample_size / len(points) for cell, ids in cells.items()}
+    counts = {cell: int(quota) for cell, quota in quotas.items()}
+    remaining = sample_size - sum(counts.values())
+    for cell in sorted(quotas, key=lambda cell: quotas[cell] - counts[cell], reverse=True)[:remaining]:
+        counts[cell] += 1
+
+    rng = random.Random(seed)
+    sample = []
+    for cell in sorted(cells):
+        sample.extend(rng.sample(cells[cell], counts[cell]))
+    return sample
+
+
+# Estimated full-run seconds per stage: measured wall time times the full/sampled row ratio of what the stage scales with
+def extrapolate_stages(stage_records, scale_factors):
+    estimates = []
+    for record in stage_records:
+        if record["stage"] in dry_run_stages:
+            continue
+        factor = scale_factors.get(stage_scaling.get(record["stage"]), 1.0)
+        estimates.append({
+            "stage": record["stage"],
+            "measured_seconds": record["wall_seconds"],
+            "scale_factor": factor,
+            "estimated_seconds": record["wall_seconds"] * factor,
+        })
+    return estimates
+
+
+# Near-intersection share, speed limit distribution and unassigned share of the sampled crashes
+def assignment_statistics(assignment_results):
+    total = len(assignment_results)
+    near_count = sum(1 for near_intersection, _ in assignment_results.values() if near_intersection == 1)
+    speed_limits = Counter(speed_limit for _, speed_limit in assignment_results.values())
+    unassigned = speed_limits.pop(None, 0)
+    return {
+        "sampled_crashes": total,
+        "near_intersection_share": near_count / total if total else None,
+        "unassigned_share": unassigned / total if total else None,
+        "speed_limit_shares": {speed_limit: count / total for speed_limit, count in sorted(speed_limits.items())},
+    }
+
+
+# Print the dry run report and write it as one JSON line to the metrics log
+def report(stage_records, scale_factors, assignment_results):
+    estimates = extrapolate_stages(stage_records, scale_factors)
+    statistics = assignment_statistics(assignment_results)
+    total_seconds = sum(estimate["estimated_seconds"] for estimate in estimates)
+
+    print("Dry run estimate for the full run:")
+    for estimate in estimates:
+        print(f"  {estimate['stage']}: {estimate['measured_seconds']:.1f} s measured x {estimate['scale_factor']:.1f} "
+              f"= {estimate['estimated_seconds'] / 60:.1f} min")
+    print(f"  Total: {total_seconds / 60:.1f} min")
+    if statistics["sampled_crashes"]:
+        print(f"Near intersections: {statistics['near_intersection_share']:.1%}, "
+              f"no speed limit: {statistics['unassigned_share']:.1%}")
+        for speed_limit, share in statistics["speed_limit_shares"].items():
+            print(f"  {speed_limit} mph: {share:.1%}")
+
+    stage_metrics.emit({
+        "event": "dry_run",
+        "scale_factors": scale_factors,
+        "stages": estimates,
+        "estimated_total_seconds": total_seconds,
+        "statistics": statistics,
+    })
+    return estimates, statistics
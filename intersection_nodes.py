@@ -0,0 +1,190 @@
+import math
+
+import numpy as np
+
+from street_store import concatenated_ranges
+
+# Intersection nodes of a street store (see street_store.py), in place of arcpy.analysis.Intersect on the street layer.
+# Intersect writes one point per pair of intersecting segments, so a four-way node comes out several times. Here the
+# part endpoints of all streets and the points where segments of two different streets cross or touch are snapped
+# to a tolerance grid, and every snapped location where at least min_streets different streets meet is one node:
+#
+#   coords              (x, y) of each node (the first endpoint or crossing snapped to it)
+#   level_masks         street level bitmask of the incident streets (bit 0 = level 1, ..., as in buffer_rules.py)
+#   incident_positions  store positions of the incident streets; node i owns
+#                       incident_positions[incident_offsets[i]:incident_offsets[i + 1]], in ascending order
+#   incident_ids        OBJECTIDs of the same streets
+#
+# Like Intersect, crossings without a shared vertex count as nodes, so overpasses are nodes as well. Crossings of a
+# street with itself and collinear overlaps (other than at their endpoints) are not nodes.
+
+
+# Sorted distinct values of an integer array
+def sorted_distinct(values):
+    values = np.sort(values)
+    return values[np.r_[True, values[1:] != values[:-1]]] if len(values) else values
+
+
+# Which vertices start or end a part of a street (interior vertices end one segment and start the next)
+def part_endpoint_flags(store):
+    vertex_count = len(store["coords"])
+    segment_starts = store["segment_starts"]
+    starts = np.zeros(vertex_count, dtype=bool)
+    starts[segment_starts] = True
+    ends = np.zeros(vertex_count, dtype=bool)
+    ends[segment_starts + 1] = True
+    return starts != ends
+
+
+# Vertices that start or end a part of a street, and the store position of their street
+def part_endpoints(store):
+    vertices = np.flatnonzero(part_endpoint_flags(store))
+    street_of_vertex = np.repeat(np.arange(len(store["ids"])), np.diff(store["vertex_offsets"]))
+    return vertices, street_of_vertex[vertices]
+
+
+# Every pair of line segments (i < j) of different streets whose extents, grown by tolerance, share a cell of a
+# hash grid with the given cell size
+def candidate_segment_pairs(extents, street_of_segment, cell_size):
+    col_min = np.floor(extents[:, 0] / cell_size).astype(np.int64)
+    row_min = np.floor(extents[:, 1] / cell_size).astype(np.int64)
+    cols = np.floor(extents[:, 2] / cell_size).astype(np.int64) - col_min + 1
+    rows = np.floor(extents[:, 3] / cell_size).astype(np.int64) - row_min + 1
+
+    # One (cell, segment) entry per cell a segment's extent covers
+    counts = cols * rows
+    segments = np.repeat(np.arange(len(extents)), counts)
+    within, _ = concatenated_ranges(np.zeros(len(extents), dtype=np.int64), counts)
+    cell_cols = col_min[segments] + within % cols[segments]
+    cell_rows = row_min[segments] + within // cols[segments]
+    order = np.lexsort((segments, cell_rows, cell_cols))
+    segments, cell_cols, cell_rows = segments[order], cell_cols[order], cell_rows[order]
+
+    # Pair every entry with the entries after it in the same cell
+    new_cell = np.r_[True, (cell_cols[1:] != cell_cols[:-1]) | (cell_rows[1:] != cell_rows[:-1])]
+    cell_ends = np.r_[np.flatnonzero(new_cell)[1:], len(segments)]
+    entry_ends = np.repeat(cell_ends, np.diff(np.r_[np.flatnonzero(new_cell), len(segments)]))
+    entries = np.arange(len(segments))
+    others, _ = concatenated_ranges(entries + 1, entry_ends)
+    first = segments[np.repeat(entries, entry_ends - entries - 1)]
+    second = segments[others]
+
+    # Segments sharing several cells are paired once
+    keep = street_of_segment[first] != street_of_segment[second]
+    pair_keys = sorted_distinct(first[keep] * len(extents) + second[keep])
+    return pair_keys // len(extents), pair_keys % len(extents)
+
+
+# Points where two segments of different streets cross or touch (within tolerance of both), with the two streets.
+# Where both segments end at a part endpoint, the endpoints already meet in the snapping and no point is returned.
+def segment_crossings(store, tolerance):
+    coords = store["coords"]
+    segment_starts = store["segment_starts"]
+    street_of_segment = np.repeat(np.arange(len(store["ids"])), np.diff(store["segment_offsets"]))
+    if len(segment_starts) < 2:
+        empty = np.empty(0, dtype=np.int64)
+        return np.empty((0, 2)), empty, empty
+
+    start_points = coords[segment_starts]
+    end_points = coords[segment_starts + 1]
+    extents = np.column_stack([
+        np.minimum(start_points, end_points) - tolerance,
+        np.maximum(start_points, end_points) + tolerance,
+    ])
+    lengths = np.hypot(*(end_points - start_points).T)
+    # About one segment per cell along a street; long segments are entered in every cell they cover
+    cell_size = max(2 * float(np.median(lengths)), 4 * tolerance, 1e-9)
+    first, second = candidate_segment_pairs(extents, street_of_segment, cell_size)
+
+    p = start_points[first]
+    r = end_points[first] - p
+    q = start_points[second]
+    s = end_points[second] - q
+    denominator = r[:, 0] * s[:, 1] - r[:, 1] * s[:, 0]
+    qp = q - p
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = (qp[:, 0] * s[:, 1] - qp[:, 1] * s[:, 0]) / denominator
+        u = (qp[:, 0] * r[:, 1] - qp[:, 1] * r[:, 0]) / denominator
+        # Parametric slack of one tolerance on each segment, so that a street ending on (or just short of)
+        # another one's interior still meets it
+        t_slack = tolerance / lengths[first]
+        u_slack = tolerance / lengths[second]
+    # Parallel segments (denominator 0) give NaN and never meet here
+    meet = (t >= -t_slack) & (t <= 1 + t_slack) & (u >= -u_slack) & (u <= 1 + u_slack)
+    endpoint = part_endpoint_flags(store)
+    at_first_end = ((t <= t_slack) & endpoint[segment_starts[first]]) | ((t >= 1 - t_slack) & endpoint[segment_starts[first] + 1])
+    at_second_end = ((u <= u_slack) & endpoint[segment_starts[second]]) | ((u >= 1 - u_slack) & endpoint[segment_starts[second] + 1])
+    meet &= ~(at_first_end & at_second_end)
+    points = p[meet] + np.clip(t[meet], 0.0, 1.0)[:, None] * r[meet]
+    return points, street_of_segment[first[meet]], street_of_segment[second[meet]]
+
+
+# Node of each point after snapping: points within tolerance of a node's first point join that node.
+# One pass over the distinct points with a hash of grid cells of tolerance size; only the 3x3 cells around a point
+# can hold a node within tolerance.
+def snap_points(points, tolerance):
+    # Street endpoints at a node mostly coincide exactly; those are merged before the pass
+    distinct, first_index, point_of_distinct = np.unique(points, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first_index, kind="stable")
+    cells = {}
+    node_points = []
+    node_of_distinct = np.empty(len(distinct), dtype=np.int64)
+    tolerance_squared = tolerance * tolerance
+    for k, (x, y) in zip(order.tolist(), distinct[order].tolist()):
+        col = math.floor(x / tolerance)
+        row = math.floor(y / tolerance)
+        node = -1
+        for neighbor in ((col + dc, row + dr) for dc in (-1, 0, 1) for dr in (-1, 0, 1)):
+            for candidate in cells.get(neighbor, ()):
+                node_x, node_y = node_points[candidate]
+                if (node_x - x) ** 2 + (node_y - y) ** 2 <= tolerance_squared:
+                    node = candidate
+                    break
+            if node >= 0:
+                break
+        if node < 0:
+            node = len(node_points)
+            node_points.append((x, y))
+            cells.setdefault((col, row), []).append(node)
+        node_of_distinct[k] = node
+    return node_of_distinct[point_of_distinct.ravel()], np.array(node_points, dtype=float).reshape(-1, 2)
+
+
+# Deduplicated intersection nodes where at least min_streets different streets meet (see the top of the file).
+# tolerance is in the units of the street layer.
+def extract_intersection_nodes(store, tolerance=0.01, min_streets=2):
+    vertices, endpoint_streets = part_endpoints(store)
+    crossing_points, crossing_first, crossing_second = segment_crossings(store, tolerance)
+    # Endpoints come first, so a node sits on a street vertex wherever it has one
+    points = np.concatenate([store["coords"][vertices], crossing_points, crossing_points])
+    point_streets = np.concatenate([endpoint_streets, crossing_first, crossing_second])
+    node_of_point, node_points = snap_points(points, tolerance)
+
+    # Distinct (node, street) pairs, sorted by node and street
+    street_count = len(store["ids"])
+    pair_keys = sorted_distinct(node_of_point * street_count + point_streets)
+    pair_nodes = pair_keys // street_count
+    pair_streets = pair_keys % street_count
+    degrees = np.bincount(pair_nodes, minlength=len(node_points))
+    kept = np.flatnonzero(degrees >= min_streets)
+    new_node = np.full(len(node_points), -1, dtype=np.int64)
+    new_node[kept] = np.arange(len(kept))
+    keep = new_node[pair_nodes] >= 0
+    pair_nodes = new_node[pair_nodes[keep]]
+    pair_streets = pair_streets[keep]
+
+    levels = store["levels"][pair_streets]
+    valid = np.isin(levels, [1, 2, 3, 4, 5])
+    level_masks = np.zeros(len(kept), dtype=np.int64)
+    np.bitwise_or.at(level_masks, pair_nodes[valid], np.left_shift(1, levels[valid].astype(np.int64) - 1))
+
+    nodes = {
+        "coords": node_points[kept],
+        "level_masks": level_masks,
+        "incident_offsets": np.r_[0, np.cumsum(np.bincount(pair_nodes, minlength=len(kept)))].astype(np.int64),
+        "incident_positions": pair_streets,
+        "incident_ids": store["ids"][pair_streets],
+    }
+    print(f"Intersection nodes extracted: {len(kept)} nodes from {len(vertices)} endpoints and "
+          f"{len(crossing_points)} crossings.")
+    return nodes
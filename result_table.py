@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+import struct
+
+import pyarrow as pa
+
+# Columnar result table of 04__Final_Code_01.py for downstream analytics (dashboards, notebooks, DuckDB):
+# one row per crash with Crash_Id, Near_Intersection, Assigned_Speed_Limit, DB_Speed_Limit, the OBJECTID of the street
+# segment the speed limit came from (Segment_ID) and the distance to it (both NULL near intersections, where the speed
+# limit is the highest of the buffer's streets), and the crash point as WKB.
+#
+# The table is a directory of part files of at most part_rows crashes each, with GeoParquet metadata so that
+# geopandas.read_parquet(directory) and other GeoParquet readers read it as one point layer. With file_format "arrow"
+# the parts are uncompressed Arrow IPC (Feather) files instead, which readers can memory-map without copying
+# (pyarrow.dataset.dataset(directory, format="ipc"), geopandas.read_feather per part).
+
+result_schema = pa.schema([
+    ("Crash_Id", pa.int64()),
+    ("Near_Intersection", pa.int16()),
+    ("Assigned_Speed_Limit", pa.int16()),
+    ("DB_Speed_Limit", pa.int16()),
+    ("Segment_ID", pa.int64()),
+    ("Distance", pa.float64()),
+    ("geometry", pa.binary()),
+])
+
+
+# WKB of a 2D point (little endian); None for a crash without a location
+def point_wkb(x, y):
+    if x is None or y is None:
+        return None
+    return struct.pack("<BIdd", 1, 1, x, y)
+
+
+# PROJJSON of an EPSG code for the GeoParquet metadata (None when pyproj is not installed or there is no code;
+# readers then treat the CRS as unknown)
+def crs_projjson(epsg_code):
+    if not epsg_code:
+        return None
+    try:
+        import pyproj
+    except ImportError:
+        return None
+    return pyproj.CRS.from_epsg(epsg_code).to_json_dict()
+
+
+# GeoParquet 1.0 file metadata for the point column
+def geo_metadata(crs):
+    return {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": {"encoding": "WKB", "geometry_types": ["Point"], "crs": crs}},
+    }
+
+
+# Arrow table of result rows (Crash_Id, Near_Intersection, Assigned_Speed_Limit, DB_Speed_Limit, Segment_ID,
+# Distance, x, y)
+def result_batch(rows, schema):
+    columns = list(zip(*rows)) if rows else [()] * 8
+    arrays = [pa.array(values, type=field.type) for values, field in zip(columns[:6], schema)]
+    arrays.append(pa.array([point_wkb(x, y) for x, y in zip(columns[6], columns[7])], type=pa.binary()))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+# Write one part file
+def write_part(table, path, file_format):
+    if file_format == "arrow":
+        import pyarrow.feather as feather
+
+        feather.write_feather(table, path, compression="uncompressed")
+    else:
+        import pyarrow.parquet as pq
+
+        pq.write_table(table, path)
+
+
+# Write the result rows to output_dir as part files of part_rows rows. The parts are written to a temporary directory
+# that replaces output_dir at the end, so readers never see a half-written table.
+def write_result_table(rows, output_dir, part_rows=500000, file_format="parquet", crs=None):
+    if file_format not in ("parquet", "arrow"):
+        raise ValueError(f"Unknown result table format {file_format!r}; expected 'parquet' or 'arrow'.")
+    schema = result_schema.with_metadata({b"geo": json.dumps(geo_metadata(crs)).encode("utf-8")})
+    temp_dir = f"{output_dir}.tmp{os.getpid()}"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+
+    part = 0
+    total = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= part_rows:
+            write_part(result_batch(batch, schema), os.path.join(temp_dir, f"part-{part:05d}.{file_format}"), file_format)
+            part += 1
+            total += len(batch)
+            batch = []
+    # An empty table still gets one part, so that readers find the schema
+    if batch or part == 0:
+        write_part(result_batch(batch, schema), os.path.join(temp_dir, f"part-{part:05d}.{file_format}"), file_format)
+        part += 1
+        total += len(batch)
+
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.rename(temp_dir, output_dir)
+    print(f"Result table written to {output_dir}: {total} crashes in {part} {file_format} parts.")
+    return total
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+import speed_limit_engine as engine
+
+# On-disk cache of the preprocessing stages (intersection nodes, street levels, buffers, per-buffer max speed).
+# The cache key is a content hash of the streets (geometry, STREET_LEVEL, SPEED_LIMIT), the intersections (with
+# their incident segments when they have them) and the buffer rules (table and unit), so a cache entry is reused until
+# one of them changes. Without an intersection layer the nodes are extracted from the streets; the key then holds the
+# snap tolerance instead, and the extracted nodes are stored in the entry, so a cache hit skips the extraction too.
+# Entries are uncompressed Arrow IPC (Feather) files, which are memory-mapped when loaded. The buffer STRtree is
+# not stored: bulk-loading it from the cached geometries takes a fraction of a second and a pickled tree is rebuilt
+# from its geometries on load anyway.
+
+cache_version = 4
+
+
+# Add the raw bytes of an array to a hash
+def hash_array(digest, values):
+    digest.update(np.ascontiguousarray(values).tobytes())
+
+
+# Content hash of everything the preprocessing depends on (intersections None: extracted with snap_tolerance)
+def preprocessing_key(streets, intersections, table=None, unit=None, snap_tolerance=0.01):
+    table = engine.buffer_table if table is None else table
+    unit = engine.buffer_unit if unit is None else unit
+    digest = hashlib.sha256(f"speed-limit-cache-v{cache_version}".encode("utf-8"))
+    for wkb in shapely.to_wkb(np.asarray(streets.geometry.values)):
+        digest.update(wkb if wkb is not None else b"")
+    hash_array(digest, streets["STREET_LEVEL"].to_numpy(dtype=float))
+    hash_array(digest, streets["SPEED_LIMIT"].to_numpy(dtype=float))
+    # Segment_IDs refer to the street index
+    digest.update("\n".join(map(str, streets.index)).encode("utf-8"))
+    if intersections is None:
+        digest.update(f"extracted:{float(snap_tolerance)!r}".encode("utf-8"))
+    else:
+        for wkb in shapely.to_wkb(np.asarray(intersections.geometry.values)):
+            digest.update(wkb if wkb is not None else b"")
+        if "Segment_IDs" in intersections.columns:
+            digest.update("\n".join(intersections["Segment_IDs"].fillna("")).encode("utf-8"))
+    hash_array(digest, np.asarray(table, dtype=float))
+    digest.update(f"unit:{unit}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+# Write the intersections and buffers of one cache entry; the entry directory appears only once it is complete
+def save_cache_entry(cache_dir, key, intersections, buffers):
+    entry_dir = os.path.join(cache_dir, key)
+    temp_dir = f"{entry_dir}.tmp{os.getpid()}"
+    os.makedirs(temp_dir, exist_ok=True)
+    intersections.to_feather(os.path.join(temp_dir, "intersections.arrow"), compression="uncompressed")
+    buffers.to_feather(os.path.join(temp_dir, "buffers.arrow"), compression="uncompressed")
+    with open(os.path.join(temp_dir, "metadata.json"), "w") as f:
+        json.dump({"cache_version": cache_version, "created": time.time(), "buffers": len(buffers)}, f)
+    try:
+        os.rename(temp_dir, entry_dir)
+    except OSError:
+        # Another run wrote the same entry first
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return entry_dir
+
+
+# Intersections and buffers of a cache entry (None when there is no entry for the key)
+def load_cache_entry(cache_dir, key):
+    entry_dir = os.path.join(cache_dir, key)
+    if not os.path.exists(os.path.join(entry_dir, "metadata.json")):
+        return None
+    intersections = gpd.read_feather(os.path.join(entry_dir, "intersections.arrow"), memory_map=True)
+    buffers = gpd.read_feather(os.path.join(entry_dir, "buffers.arrow"), memory_map=True)
+    return intersections, buffers
+
+
+# Intersections and buffers for the given streets, from the cache when the inputs are unchanged. Without
+# intersections (None) the nodes are extracted from the streets with snap_tolerance, only when the entry is missing.
+def load_or_build_buffers(intersections, streets, cache_dir, table=None, unit=None, snap_tolerance=0.01):
+    key = preprocessing_key(streets, intersections, table, unit, snap_tolerance)
+    start = time.perf_counter()
+    entry = load_cache_entry(cache_dir, key)
+    if entry is not None:
+        print(f"Loaded {len(entry[1])} cached buffers from {os.path.join(cache_dir, key)} "
+              f"in {time.perf_counter() - start:.2f} s.")
+        return entry
+
+    if intersections is None:
+        intersections = engine.extract_intersections(streets, snap_tolerance)
+    buffers = engine.build_buffers(intersections, streets, table, unit)
+    entry_dir = save_cache_entry(cache_dir, key, intersections, buffers)
+    print(f"Cached {len(buffers)} buffers in {entry_dir}")
+    return intersections, buffers
@@ -0,0 +1,480 @@
+import argparse
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from buffer_rules import buffer_size_text, default_rules_file, load_buffer_table, mask_to_text
+
+# Speed limit assignment without arcpy.
+# Runs the same stages as 04__Final_Code_01.py (intersection street levels, buffer creation,
+# buffer recalculation, within-buffer test, nearest street) as batch operations on shapely 2
+# geometry arrays, so it can run on any machine with GeoPandas. Buffers are kept as circles (center and radius).
+
+# Buffer size rules by street level combination, compiled into a lookup array indexed by a 5-bit street level mask
+buffer_table, buffer_unit = load_buffer_table(default_rules_file)
+buffer_table = np.array(buffer_table)
+
+valid_street_levels = [1, 2, 3, 4, 5]
+
+# Segments per quarter circle of the buffer polygons written for display
+buffer_quad_segs = 32
+
+
+# Read a GeoPackage, Shapefile or (Geo)Parquet layer
+def read_layer(path, layer=None):
+    if os.path.splitext(path)[1].lower() in (".parquet", ".geoparquet"):
+        return gpd.read_parquet(path)
+    return gpd.read_file(path, layer=layer)
+
+
+# Write the assigned crashes to GeoPackage, Shapefile or (Geo)Parquet
+def write_layer(gdf, path, layer=None):
+    if os.path.splitext(path)[1].lower() in (".parquet", ".geoparquet"):
+        gdf.to_parquet(path)
+    else:
+        gdf.to_file(path, layer=layer)
+
+
+# Read a layer in chunks of at most chunk_size features without loading the whole layer.
+# Parquet is read by row batches; other formats are streamed through GDAL's Arrow interface.
+def read_layer_chunks(path, chunk_size, layer=None):
+    if os.path.splitext(path)[1].lower() in (".parquet", ".geoparquet"):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        geo = json.loads(parquet_file.schema_arrow.metadata[b"geo"])
+        geometry_name = geo["primary_column"]
+        crs = geo["columns"][geometry_name].get("crs")
+        for batch in parquet_file.iter_batches(batch_size=chunk_size):
+            yield chunk_frame(batch, geometry_name, crs)
+    else:
+        import pyogrio
+
+        with pyogrio.open_arrow(path, layer=layer, batch_size=chunk_size, use_pyarrow=True) as (meta, reader):
+            for batch in reader:
+                yield chunk_frame(batch, meta["geometry_name"] or "wkb_geometry", meta["crs"])
+
+
+# GeoDataFrame of an Arrow record batch with a WKB geometry column
+def chunk_frame(batch, geometry_name, crs):
+    frame = batch.to_pandas()
+    geometry = shapely.from_wkb(frame.pop(geometry_name).to_numpy())
+    return gpd.GeoDataFrame(frame, geometry=geometry, crs=crs)
+
+
+# Writes chunks of a layer as they come: Parquet output becomes a directory of part files
+# (read back with gpd.read_parquet on the directory); other formats are appended to one layer.
+def chunk_writer(path, layer=None):
+    parquet = os.path.splitext(path)[1].lower() in (".parquet", ".geoparquet")
+    if parquet:
+        os.makedirs(path, exist_ok=True)
+    part = 0
+    while True:
+        chunk = yield
+        if parquet:
+            chunk.to_parquet(os.path.join(path, f"part-{part:05d}.parquet"))
+        else:
+            chunk.to_file(path, layer=layer, mode="w" if part == 0 else "a")
+        part += 1
+
+
+# Street store (street_store.py) of a street layer; the segment IDs are the layer's index values
+def street_store_of(streets):
+    from street_store import build_street_store
+
+    return build_street_store(
+        (street_id, level, speed, [shapely.get_coordinates(part).tolist() for part in shapely.get_parts(geometry)])
+        for street_id, level, speed, geometry in zip(
+            streets.index, streets["STREET_LEVEL"].to_numpy(dtype=float), streets["SPEED_LIMIT"].to_numpy(dtype=float),
+            streets.geometry.values)
+        if geometry is not None
+    )
+
+
+# Intersection nodes of a street layer (see intersection_nodes.py), one point per node with the street level bitmask
+# and the index values of its incident streets (comma-separated in Segment_IDs)
+def extract_intersections(streets, tolerance=0.01):
+    from intersection_nodes import extract_intersection_nodes
+
+    nodes = extract_intersection_nodes(street_store_of(streets), tolerance)
+    offsets = nodes["incident_offsets"]
+    return gpd.GeoDataFrame(
+        {
+            "Street_Level_Mask": nodes["level_masks"],
+            "Segment_IDs": [",".join(map(str, nodes["incident_ids"][offsets[node]:offsets[node + 1]].tolist()))
+                            for node in range(len(nodes["coords"]))],
+        },
+        geometry=shapely.points(nodes["coords"]),
+        crs=streets.crs,
+    )
+
+
+# (intersection index, street index) pairs of the incident streets listed in the Segment_IDs of extracted
+# intersections (see extract_intersections); None for intersections without adjacency
+def incident_pairs(intersections, streets):
+    if "Segment_IDs" not in intersections.columns:
+        return None
+    segment_ids = [[int(segment_id) for segment_id in text.split(",") if segment_id] if isinstance(text, str) else []
+                   for text in intersections["Segment_IDs"]]
+    street_idx = streets.index.get_indexer([segment_id for ids in segment_ids for segment_id in ids])
+    intersection_idx = np.repeat(np.arange(len(intersections)), [len(ids) for ids in segment_ids])
+    known = street_idx >= 0
+    return intersection_idx[known], street_idx[known]
+
+
+# Streets within reach of each intersection: intersection and street index, the closest and farthest distance of the
+# street from the intersection, whether the street is incident to its node (extracted intersections only), and the
+# street's level bit and speed limit. A street crosses a buffer of radius r when closest < r < farthest.
+def node_street_pairs(intersections, streets, reach):
+    points = intersections.geometry.values
+    node_idx, street_idx = streets.sindex.query(points, predicate="dwithin", distance=reach)
+    street_geometries = streets.geometry.values[street_idx]
+    node_points = points[node_idx]
+    incident = np.zeros(len(node_idx), dtype=bool)
+    pairs = incident_pairs(intersections, streets)
+    if pairs is not None:
+        incident = np.isin(node_idx * len(streets) + street_idx, pairs[0] * len(streets) + pairs[1])
+
+    levels = streets["STREET_LEVEL"].to_numpy(dtype=float)[street_idx]
+    valid = np.isin(levels, valid_street_levels)
+    level_bits = np.zeros(len(street_idx), dtype=np.int64)
+    level_bits[valid] = np.left_shift(1, levels[valid].astype(np.int64) - 1)
+    return {
+        "node_idx": node_idx,
+        "closest": shapely.distance(node_points, street_geometries),
+        # The farthest point of a line from a point is one of its vertices, which is what the discrete
+        # Hausdorff distance measures
+        "farthest": shapely.hausdorff_distance(node_points, street_geometries),
+        "incident": incident,
+        "level_bits": level_bits,
+        "speeds": streets["SPEED_LIMIT"].to_numpy(dtype=float)[street_idx],
+        "node_count": len(points),
+    }
+
+
+# Street level bitmask per intersection of the selected pairs
+def pair_masks(pairs, selected):
+    masks = np.zeros(pairs["node_count"], dtype=np.int64)
+    np.bitwise_or.at(masks, pairs["node_idx"][selected], pairs["level_bits"][selected])
+    return masks
+
+
+# Initial buffer radius of every intersection under one rule table: the buffer size for the levels of its incident
+# streets (the default size for intersections without incident streets)
+def initial_buffer_radius(pairs, table):
+    return table[pair_masks(pairs, pairs["incident"])]
+
+
+# Recalculated buffer radius, street level mask and highest non-NULL speed limit (NaN when none) of every intersection.
+# The size is recalculated from the streets of the initial buffer (incident or crossing it), and the speed limit
+# comes from the streets of the final buffer.
+def recalculate_buffer_radius(pairs, table, initial_radius):
+    node_idx = pairs["node_idx"]
+    crossing = (pairs["closest"] < initial_radius[node_idx]) & (pairs["farthest"] > initial_radius[node_idx])
+    masks = pair_masks(pairs, pairs["incident"] | crossing)
+    radius = np.where(masks != 0, table[masks], initial_radius)
+
+    crossing = (pairs["closest"] < radius[node_idx]) & (pairs["farthest"] > radius[node_idx])
+    selected = (pairs["incident"] | crossing) & ~np.isnan(pairs["speeds"])
+    max_speeds = np.full(pairs["node_count"], np.nan)
+    np.fmax.at(max_speeds, node_idx[selected], pairs["speeds"][selected])
+    return radius, masks, max_speeds
+
+
+# Buffer radius, street level mask and highest non-NULL speed limit of every intersection under one rule table
+def circle_buffers(pairs, table):
+    return recalculate_buffer_radius(pairs, table, initial_buffer_radius(pairs, table))
+
+
+# Intersection buffers as circles: the intersection point with its Buffer_Distance, street levels and
+# Max_Speed_Limit. No polygon is built; buffer_polygons makes them for display.
+# table is a compiled buffer rule table (buffer_rules.load_buffer_table); the final rule set by default.
+def build_buffers(intersections, streets, table=None, unit=None):
+    table = buffer_table if table is None else np.asarray(table)
+    unit = buffer_unit if unit is None else unit
+    pairs = node_street_pairs(intersections, streets, float(table.max()))
+    distances, masks, max_speeds = circle_buffers(pairs, table)
+    print(f"Buffers around intersections sized: {len(distances)} buffers, {int((masks != 0).sum())} with street levels.")
+
+    return gpd.GeoDataFrame(
+        {
+            "Buffer_Size": [buffer_size_text(distance, unit) for distance in distances],
+            "Street_Levels": [mask_to_text(mask) for mask in masks],
+            "Street_Level_Mask": masks,
+            "Buffer_Distance": distances,
+            "Intersection_FID": np.arange(len(distances)),
+            "Max_Speed_Limit": max_speeds,
+        },
+        geometry=np.asarray(intersections.geometry.values),
+        crs=intersections.crs,
+    )
+
+
+# Copy of the buffers with circle polygons instead of centers, for map display
+def buffer_polygons(buffers):
+    polygons = buffers.copy()
+    polygons.geometry = shapely.buffer(
+        np.asarray(buffers.geometry.values), buffers["Buffer_Distance"].to_numpy(dtype=float), quad_segs=buffer_quad_segs)
+    return polygons
+
+
+# Every (point index, buffer index) pair where the point is within the buffer's radius of its center; overlapping
+# buffers give several pairs. One radius query of the buffer center tree with the largest radius finds the
+# candidates, and each pair is then a distance <= Buffer_Distance comparison.
+def points_within_buffers(points, buffers):
+    points = np.asarray(points)
+    if len(buffers) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    radius = buffers["Buffer_Distance"].to_numpy(dtype=float)
+    point_idx, buffer_idx = buffers.sindex.query(points, predicate="dwithin", distance=float(radius.max()))
+    inside = shapely.distance(points[point_idx], np.asarray(buffers.geometry.values)[buffer_idx]) <= radius[buffer_idx]
+    return point_idx[inside], buffer_idx[inside]
+
+
+# Speed limit and distance of the nearest street with a non-NULL SPEED_LIMIT.
+# Ties go to the street read first, like the cursor scan in the arcpy script.
+# With max_distance, points with no street within that distance are left NaN.
+def nearest_street_speed_limits(points, streets, max_distance=None):
+    speed_limits = streets["SPEED_LIMIT"].to_numpy(dtype=float)
+    candidates = np.flatnonzero(~np.isnan(speed_limits))
+    nearest_speeds = np.full(len(points), np.nan)
+    nearest_distances = np.full(len(points), np.nan)
+    if len(candidates) == 0 or len(points) == 0:
+        return nearest_speeds, nearest_distances
+
+    if len(candidates) == len(streets):
+        # Every street has a speed limit: reuse the layer's spatial index, which is built once per layer
+        (point_idx, tree_idx), distances = streets.sindex.nearest(
+            points, max_distance=max_distance, return_distance=True, return_all=True
+        )
+    else:
+        tree = shapely.STRtree(streets.geometry.values[candidates])
+        (point_idx, tree_idx), distances = tree.query_nearest(
+            points, max_distance=max_distance, return_distance=True, all_matches=True
+        )
+    # Sorting by point then street order leaves the first-read street first among ties
+    order = np.lexsort((candidates[tree_idx], point_idx))
+    point_idx, tree_idx, distances = point_idx[order], tree_idx[order], distances[order]
+    first = np.ones(len(point_idx), dtype=bool)
+    first[1:] = point_idx[1:] != point_idx[:-1]
+    nearest_speeds[point_idx[first]] = speed_limits[candidates[tree_idx[first]]]
+    nearest_distances[point_idx[first]] = distances[first]
+    return nearest_speeds, nearest_distances
+
+
+# Near_Intersection flags, assigned speed limits and nearest-street distances for an array of crash points.
+# With max_distance, crashes not near an intersection whose nearest street is farther away are flagged unresolved.
+def assign_points(points, buffers, streets, max_distance=None):
+    near_intersection = np.zeros(len(points), dtype=bool)
+    assigned = np.full(len(points), np.nan)
+    distances = np.full(len(points), np.nan)
+
+    # Check if crash points are within any buffer. A crash inside several overlapping buffers takes the highest
+    # Max_Speed_Limit among them; buffers without any speed limit do not count.
+    max_speeds = buffers["Max_Speed_Limit"].to_numpy(dtype=float)
+    point_idx, buffer_idx = points_within_buffers(points, buffers)
+    near_intersection[point_idx] = True
+    np.fmax.at(assigned, point_idx, max_speeds[buffer_idx])
+
+    # Find the nearest street segment for crashes not near an intersection
+    far = np.flatnonzero(~near_intersection)
+    nearest_speeds, nearest_distances = nearest_street_speed_limits(points[far], streets, max_distance)
+    assigned[far] = nearest_speeds
+    distances[far] = nearest_distances
+
+    unresolved = np.zeros(len(points), dtype=bool)
+    if max_distance is not None:
+        unresolved[far] = np.isnan(nearest_distances)
+    return near_intersection, assigned, distances, unresolved
+
+
+# Copy of the crashes with the Near_Intersection and Assigned_Speed_Limit fields (NULL where not set)
+def with_result_fields(crashes, near_intersection, assigned):
+    result = crashes.copy()
+    result["Near_Intersection"] = pd.array(np.where(near_intersection, 1, pd.NA), dtype="Int16")
+    result["Assigned_Speed_Limit"] = pd.array(np.where(np.isnan(assigned), pd.NA, assigned), dtype="Int16")
+    return result
+
+
+def crash_result(crashes, near_intersection, assigned):
+    result = with_result_fields(crashes, near_intersection, assigned)
+    print(f"Speed limit assignment complete: {len(result)} crashes, {int(near_intersection.sum())} near intersections.")
+    return result
+
+
+# Assign Near_Intersection and Assigned_Speed_Limit to every crash (buffers come from build_buffers)
+def assign_speed_limits(crashes, buffers, streets):
+    near_intersection, assigned, _, _ = assign_points(crashes.geometry.values, buffers, streets)
+    return crash_result(crashes, near_intersection, assigned)
+
+
+# Stream the crashes from crashes_path to output_path in chunks of chunk_size. Only the streets, the buffers and
+# one chunk of crashes are in memory at a time, so the crash count does not limit the size of the run.
+def assign_speed_limits_streaming(crashes_path, output_path, buffers, streets, chunk_size=100000, layer=None):
+    # Streets without a speed limit never win the nearest-street search; dropping them up front lets every chunk
+    # reuse one street index (the order of the remaining streets, which decides ties, is kept)
+    streets = streets[streets["SPEED_LIMIT"].notna()].reset_index(drop=True)
+    writer = chunk_writer(output_path)
+    next(writer)
+    total = 0
+    near_total = 0
+    for chunk in read_layer_chunks(crashes_path, chunk_size, layer):
+        near_intersection, assigned, _, _ = assign_points(chunk.geometry.values, buffers, streets)
+        writer.send(with_result_fields(chunk, near_intersection, assigned))
+        total += len(chunk)
+        near_total += int(near_intersection.sum())
+        print(f"Processed {total} crashes.")
+    writer.close()
+    print(f"Speed limit assignment complete: {total} crashes, {near_total} near intersections.")
+    return total
+
+
+# Worker for one tile: crash positions in the full layer plus the tile's assignment arrays
+def assign_tile(positions, points, buffers, streets, search_radius):
+    return (positions,) + assign_points(points, buffers, streets, max_distance=search_radius)
+
+
+# Same result as assign_speed_limits, with the crashes split into square tiles assigned in parallel worker processes.
+# Each tile only gets the buffers and streets within a halo of the largest buffer radius + search_radius around it.
+# A street outside the halo is farther than search_radius from every crash in the tile, so a nearest street found
+# within search_radius is exact; crashes with no street that close are resolved afterwards against all streets.
+def assign_speed_limits_parallel(crashes, buffers, streets, workers=None, tile_size=None, search_radius=1000.0):
+    workers = workers or os.cpu_count() or 1
+    points = crashes.geometry.values
+    near_intersection = np.zeros(len(points), dtype=bool)
+    assigned = np.full(len(points), np.nan)
+    distances = np.full(len(points), np.nan)
+    unresolved = np.zeros(len(points), dtype=bool)
+    if len(points) == 0:
+        return crash_result(crashes, near_intersection, assigned)
+
+    x = shapely.get_x(points)
+    y = shapely.get_y(points)
+    if tile_size is None:
+        # About four tiles per worker so that dense and sparse tiles even out
+        span = max(x.max() - x.min(), y.max() - y.min()) or 1.0
+        tile_size = span / math.ceil(math.sqrt(4 * workers))
+    cols = np.floor((x - x.min()) / tile_size).astype(np.int64)
+    rows = np.floor((y - y.min()) / tile_size).astype(np.int64)
+    tile_keys, tile_of_crash = np.unique(np.stack([cols, rows], axis=1), axis=0, return_inverse=True)
+    tile_of_crash = tile_of_crash.ravel()
+
+    max_buffer_radius = float(buffers["Buffer_Distance"].max()) if len(buffers) else 0.0
+    halo = max_buffer_radius + search_radius
+    street_columns = ["SPEED_LIMIT", streets.geometry.name]
+    buffer_columns = ["Buffer_Distance", "Max_Speed_Limit", buffers.geometry.name]
+    tasks = []
+    for tile, (col, row) in enumerate(tile_keys):
+        positions = np.flatnonzero(tile_of_crash == tile)
+        x_min = x.min() + col * tile_size - halo
+        y_min = y.min() + row * tile_size - halo
+        x_max = x.min() + (col + 1) * tile_size + halo
+        y_max = y.min() + (row + 1) * tile_size + halo
+        area = shapely.box(x_min, y_min, x_max, y_max)
+        # Sorted positions keep the original street order, which decides ties
+        street_idx = np.sort(streets.sindex.query(area))
+        buffer_idx = np.sort(buffers.sindex.query(area))
+        tasks.append((positions, points[positions], buffers[buffer_columns].iloc[buffer_idx],
+                      streets[street_columns].iloc[street_idx], search_radius))
+
+    print(f"Assigning {len(points)} crashes in {len(tasks)} tiles with {workers} workers.")
+    if workers == 1:
+        tile_results = [assign_tile(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            tile_results = list(executor.map(assign_tile, *zip(*tasks)))
+
+    # Merge the tiles back by crash position
+    for positions, tile_near, tile_assigned, tile_distances, tile_unresolved in tile_results:
+        near_intersection[positions] = tile_near
+        assigned[positions] = tile_assigned
+        distances[positions] = tile_distances
+        unresolved[positions] = tile_unresolved
+
+    # Crashes without a street within search_radius are searched against the whole street network
+    remaining = np.flatnonzero(unresolved)
+    if len(remaining):
+        assigned[remaining], distances[remaining] = nearest_street_speed_limits(points[remaining], streets)
+        print(f"{len(remaining)} crashes had no street within {search_radius} and were resolved against all streets.")
+
+    return crash_result(crashes, near_intersection, assigned)
+
+
+# Rows where the assignment differs from a reference run (e.g. Crashes_Subset_2_Copy exported from the arcpy script)
+def compare_with_reference(result, reference, id_field="Crash_Id", fields=("Near_Intersection", "Assigned_Speed_Limit")):
+    fields = list(fields)
+    merged = result[[id_field] + fields].merge(
+        reference[[id_field] + fields], on=id_field, how="outer", suffixes=("", "_Reference"), indicator=True
+    )
+    mismatch = merged["_merge"] != "both"
+    for field in fields:
+        ours = merged[field].astype("Float64")
+        theirs = merged[f"{field}_Reference"].astype("Float64")
+        mismatch |= (ours.isna() != theirs.isna()) | (ours.notna() & theirs.notna() & (ours != theirs)).fillna(False)
+    return merged[mismatch].drop(columns="_merge")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Assign speed limits to crash points without arcpy.")
+    parser.add_argument("streets", help="Street segments with STREET_LEVEL and SPEED_LIMIT (GeoPackage, Shapefile or Parquet)")
+    parser.add_argument("crashes", help="Crash points")
+    parser.add_argument("intersections", nargs="?", help="Intersection points (extracted from the streets when left out)")
+    parser.add_argument("output", help="Output path for the assigned crashes")
+    parser.add_argument("--buffers-output", help="Optional output path for the intersection buffer polygons (for map display)")
+    parser.add_argument("--buffer-rules", default=default_rules_file, help="Buffer size rule file (CSV or YAML)")
+    parser.add_argument("--compare", help="Output of the arcpy script on the same inputs to check against")
+    parser.add_argument("--id-field", default="Crash_Id", help="Field used to match crashes when comparing")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for tiled assignment (1 runs serially)")
+    parser.add_argument("--tile-size", type=float, help="Tile edge length in layer units (default: about four tiles per worker)")
+    parser.add_argument("--search-radius", type=float, default=1000.0, help="Nearest-street search radius inside a tile")
+    parser.add_argument("--chunk-size", type=int, help="Stream the crashes in chunks of this many rows (Parquet output is a directory of parts)")
+    parser.add_argument("--cache-dir", help="Directory for cached buffers, reused while streets, intersections and rules are unchanged")
+    parser.add_argument("--snap-tolerance", type=float, default=0.01, help="Snap tolerance for extracted intersection nodes")
+    args = parser.parse_args()
+
+    streets = read_layer(args.streets)
+    intersections = read_layer(args.intersections) if args.intersections else None
+
+    # Without an intersection layer the nodes are extracted from the streets (on a cache miss only with --cache-dir)
+    table, unit = load_buffer_table(args.buffer_rules)
+    if args.cache_dir:
+        from speed_limit_cache import load_or_build_buffers
+
+        _, buffers = load_or_build_buffers(intersections, streets, args.cache_dir, np.array(table), unit, args.snap_tolerance)
+    else:
+        if intersections is None:
+            intersections = extract_intersections(streets, args.snap_tolerance)
+        buffers = build_buffers(intersections, streets, np.array(table), unit)
+    if args.buffers_output:
+        write_layer(buffer_polygons(buffers), args.buffers_output)
+
+    if args.chunk_size:
+        assign_speed_limits_streaming(args.crashes, args.output, buffers, streets, args.chunk_size)
+        print(f"Assigned crashes written to {args.output}")
+        if args.compare:
+            result = read_layer(args.output)
+    else:
+        crashes = read_layer(args.crashes)
+        if args.workers > 1:
+            result = assign_speed_limits_parallel(crashes, buffers, streets, args.workers, args.tile_size, args.search_radius)
+        else:
+            result = assign_speed_limits(crashes, buffers, streets)
+        write_layer(result, args.output)
+        print(f"Assigned crashes written to {args.output}")
+
+    if args.compare:
+        mismatches = compare_with_reference(result, read_layer(args.compare), args.id_field)
+        print(f"Comparison with {args.compare}: {len(mismatches)} mismatching crashes.")
+        if len(mismatches):
+            print(mismatches.head(20).to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import shapely
+
+import speed_limit_engine as engine
+from buffer_rules import default_rules_file, load_buffer_table
+
+# Evaluation of several buffer rule sets (scenarios) in one pass, without writing buffers.
+# Buffers are circles around the intersection nodes, so everything the rule sets are applied to is computed once:
+# the distance from every crash to the nodes within the largest buffer size of any scenario, the closest and farthest
+# distance of every street near a node (see speed_limit_engine.node_street_pairs) and the nearest street of every
+# crash. Each scenario then only sizes its buffers with its own table, and derives Near_Intersection and
+# Assigned_Speed_Limit from these arrays, with the same result as a speed_limit_engine.py run per rule set.
+
+
+# Scenario name of a rule file, used in the result column names
+def scenario_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+# Near_Intersection and Assigned_Speed_Limit of every crash under every rule table, sharing the geometry work
+def evaluate_scenarios(crashes, intersections, streets, tables):
+    reach = max(float(np.max(table)) for table in tables)
+    pairs = engine.node_street_pairs(intersections, streets, reach)
+
+    points = crashes.geometry.values
+    crash_idx, node_idx = intersections.sindex.query(points, predicate="dwithin", distance=reach)
+    distances = shapely.distance(points[crash_idx], intersections.geometry.values[node_idx])
+    nearest_speeds, _ = engine.nearest_street_speed_limits(points, streets)
+    print(f"Shared distances computed: {len(crash_idx)} crash-intersection pairs, {len(pairs['node_idx'])} "
+          f"intersection-street pairs.")
+
+    results = []
+    for table in tables:
+        radius, _, max_speeds = engine.circle_buffers(pairs, table)
+        inside = distances <= radius[node_idx]
+        near_intersection = np.zeros(len(points), dtype=bool)
+        near_intersection[crash_idx[inside]] = True
+        assigned = np.where(near_intersection, np.nan, nearest_speeds)
+        np.fmax.at(assigned, crash_idx[inside], max_speeds[node_idx[inside]])
+        results.append((near_intersection, assigned))
+    return results
+
+
+# Wide result table: the crashes with a Near_Intersection_<name> and Assigned_Speed_Limit_<name> column per scenario
+def scenario_table(crashes, names, results):
+    table = crashes.copy()
+    for name, (near_intersection, assigned) in zip(names, results):
+        fields = engine.with_result_fields(crashes[[]], near_intersection, assigned)
+        table[f"Near_Intersection_{name}"] = fields["Near_Intersection"]
+        table[f"Assigned_Speed_Limit_{name}"] = fields["Assigned_Speed_Limit"]
+    return table
+
+
+# Crashes changing category between every pair of scenarios: into or out of an intersection buffer, and to another
+# assigned speed limit
+def change_summary(names, results):
+    rows = []
+    for i in range(len(names)):
+        for j in range(i + 1, len(names)):
+            near_a, assigned_a = results[i]
+            near_b, assigned_b = results[j]
+            rows.append({
+                "scenario_a": names[i],
+                "scenario_b": names[j],
+                "near_a": int(near_a.sum()),
+                "near_b": int(near_b.sum()),
+                "became_near": int((~near_a & near_b).sum()),
+                "no_longer_near": int((near_a & ~near_b).sum()),
+                "speed_limit_changed": int(
+                    (np.isnan(assigned_a) != np.isnan(assigned_b)).sum()
+                    + (~np.isnan(assigned_a) & ~np.isnan(assigned_b) & (assigned_a != assigned_b)).sum()
+                ),
+            })
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare buffer rule sets on the same crashes in one pass.")
+    parser.add_argument("streets", help="Street segments with STREET_LEVEL and SPEED_LIMIT")
+    parser.add_argument("crashes", help="Crash points")
+    parser.add_argument("intersections", nargs="?", help="Intersection points (extracted from the streets when left out)")
+    parser.add_argument("output", help="Output path for the wide result table")
+    parser.add_argument("--rules", nargs="+", default=[default_rules_file], help="Buffer size rule files, one per scenario")
+    parser.add_argument("--summary", help="CSV file for the category change summary")
+    parser.add_argument("--snap-tolerance", type=float, default=0.01, help="Snap tolerance for extracted intersection nodes")
+    args = parser.parse_args()
+
+    names = [scenario_name(path) for path in args.rules]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Rule files need distinct names: {names}")
+    tables = []
+    units = set()
+    for path in args.rules:
+        table, unit = load_buffer_table(path)
+        tables.append(np.array(table))
+        units.add(unit)
+    if len(units) > 1:
+        raise ValueError(f"Rule files use different units: {sorted(units)}")
+
+    streets = engine.read_layer(args.streets)
+    crashes = engine.read_layer(args.crashes)
+    if args.intersections:
+        intersections = engine.read_layer(args.intersections)
+    else:
+        intersections = engine.extract_intersections(streets, args.snap_tolerance)
+
+    results = evaluate_scenarios(crashes, intersections, streets, tables)
+    engine.write_layer(scenario_table(crashes, names, results), args.output)
+    print(f"Scenario results written to {args.output}")
+
+    summary = change_summary(names, results)
+    print(summary.to_string(index=False))
+    if args.summary:
+        summary.to_csv(args.summary, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import shapely
+
+import speed_limit_engine as engine
+import stage_metrics
+from buffer_rules import default_rules_file, load_buffer_table
+
+# Long-running speed limit assignment service.
+# The streets, intersection buffers and per-buffer max speeds are loaded once and their spatial indexes are kept warm.
+# Points can be assigned in-process with assign() or over HTTP:
+#   POST /assign  {"points": [[x, y], ...]}  (coordinates in the street layer's CRS)
+#   GET  /metrics request latency percentiles and batch sizes
+# Requests that arrive while a batch is being assigned are collected for up to batch_wait seconds and assigned
+# together, so many concurrent single-crash requests cost about as much as one batch.
+
+# Latencies kept for the /metrics percentiles
+latency_window = 10000
+
+
+# Load the network once and start the batch worker (intersections are extracted from the streets without intersections_path)
+def load_service(streets_path, intersections_path, rules_file=default_rules_file, cache_dir=None, batch_wait=0.002,
+                 snap_tolerance=0.01):
+    streets = engine.read_layer(streets_path)
+    intersections = engine.read_layer(intersections_path) if intersections_path else None
+    table, unit = load_buffer_table(rules_file)
+    if cache_dir:
+        from speed_limit_cache import load_or_build_buffers
+
+        _, buffers = load_or_build_buffers(intersections, streets, cache_dir, np.array(table), unit, snap_tolerance)
+    else:
+        if intersections is None:
+            intersections = engine.extract_intersections(streets, snap_tolerance)
+        buffers = engine.build_buffers(intersections, streets, np.array(table), unit)
+
+    # Streets without a speed limit never win the nearest-street search (see assign_speed_limits_streaming)
+    streets = streets[streets["SPEED_LIMIT"].notna()].reset_index(drop=True)
+    # Build the spatial indexes now rather than on the first request
+    buffers.sindex
+    streets.sindex
+
+    service = {
+        "streets": streets,
+        "buffers": buffers,
+        "batch_wait": batch_wait,
+        "queue": queue.Queue(),
+        "latencies": deque(maxlen=latency_window),
+        "batch_sizes": deque(maxlen=latency_window),
+        "requests": 0,
+        "lock": threading.Lock(),
+    }
+    threading.Thread(target=batch_worker, args=(service,), daemon=True).start()
+    print(f"Service ready: {len(streets)} streets with speed limits, {len(buffers)} buffers.")
+    return service
+
+
+# Collect queued requests for up to batch_wait seconds and assign all their points in one call
+def batch_worker(service):
+    while True:
+        requests = [service["queue"].get()]
+        deadline = time.perf_counter() + service["batch_wait"]
+        while (remaining := deadline - time.perf_counter()) > 0:
+            try:
+                requests.append(service["queue"].get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        points = np.concatenate([request["points"] for request in requests])
+        try:
+            near_intersection, assigned, distances, _ = engine.assign_points(
+                points, service["buffers"], service["streets"])
+        except Exception as error:
+            for request in requests:
+                request["error"] = error
+                request["done"].set()
+            continue
+
+        start = 0
+        for request in requests:
+            end = start + len(request["points"])
+            request["result"] = (near_intersection[start:end], assigned[start:end], distances[start:end])
+            request["done"].set()
+            start = end
+        with service["lock"]:
+            service["batch_sizes"].append(len(points))
+
+
+# Assign a batch of (x, y) coordinates. Each result has Near_Intersection (1 or None), Assigned_Speed_Limit
+# (None when no speed limit applies) and Distance to the street the speed limit came from (None for crashes
+# near an intersection, which take the highest speed limit of the streets crossing the buffer).
+def assign(service, coordinates):
+    start = time.perf_counter()
+    request = {
+        "points": shapely.points(np.asarray(coordinates, dtype=float).reshape(-1, 2)),
+        "done": threading.Event(),
+    }
+    service["queue"].put(request)
+    request["done"].wait()
+    if "error" in request:
+        raise request["error"]
+
+    near_intersection, assigned, distances = request["result"]
+    results = [
+        {
+            "Near_Intersection": 1 if near else None,
+            "Assigned_Speed_Limit": None if np.isnan(speed) else int(speed),
+            "Distance": None if np.isnan(distance) else float(distance),
+        }
+        for near, speed, distance in zip(near_intersection, assigned, distances)
+    ]
+    latency_ms = (time.perf_counter() - start) * 1000
+    with service["lock"]:
+        service["latencies"].append(latency_ms)
+        service["requests"] += 1
+    stage_metrics.emit({"event": "request", "points": len(results), "latency_ms": latency_ms})
+    return results, latency_ms
+
+
+# Request count, latency percentiles (ms) and mean batch size over the recent requests
+def service_metrics(service):
+    with service["lock"]:
+        latencies = np.array(service["latencies"])
+        batch_sizes = np.array(service["batch_sizes"])
+        requests = service["requests"]
+    metrics = {"requests": requests, "batches": len(batch_sizes)}
+    if len(latencies):
+        metrics.update({
+            "latency_ms_p50": float(np.percentile(latencies, 50)),
+            "latency_ms_p95": float(np.percentile(latencies, 95)),
+            "latency_ms_p99": float(np.percentile(latencies, 99)),
+            "latency_ms_max": float(latencies.max()),
+        })
+    if len(batch_sizes):
+        metrics["mean_batch_points"] = float(batch_sizes.mean())
+    return metrics
+
+
+class AssignmentHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send_json(200, service_metrics(self.service))
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/assign":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            coordinates = np.asarray(body["points"], dtype=float)
+            if coordinates.ndim != 2 or coordinates.shape[1] != 2:
+                raise ValueError("points must be a list of [x, y] pairs")
+        except (KeyError, TypeError, ValueError) as error:
+            self.send_json(400, {"error": str(error)})
+            return
+        results, latency_ms = assign(self.service, coordinates)
+        self.send_json(200, {"results": results, "latency_ms": latency_ms})
+
+    # Per-request lines go to the metrics log instead of stderr
+    def log_message(self, format, *args):
+        pass
+
+
+class AssignmentServer(ThreadingHTTPServer):
+    # Intake tools send bursts of single-crash requests; the default listen backlog of 5 would reset connections
+    request_queue_size = 256
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve speed limit assignments from a warm street and buffer index.")
+    parser.add_argument("streets", help="Street segments with STREET_LEVEL and SPEED_LIMIT")
+    parser.add_argument("intersections", nargs="?", help="Intersection points (extracted from the streets when left out)")
+    parser.add_argument("--buffer-rules", default=default_rules_file, help="Buffer size rule file (CSV or YAML)")
+    parser.add_argument("--cache-dir", help="Directory for cached buffers (see speed_limit_cache.py)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--batch-wait-ms", type=float, default=2.0, help="How long to collect concurrent requests into one batch")
+    parser.add_argument("--metrics-log", help="JSON lines file for per-request latencies")
+    parser.add_argument("--snap-tolerance", type=float, default=0.01, help="Snap tolerance for extracted intersection nodes")
+    args = parser.parse_args()
+
+    stage_metrics.metrics_log = args.metrics_log
+    AssignmentHandler.service = load_service(
+        args.streets, args.intersections, args.buffer_rules, args.cache_dir, args.batch_wait_ms / 1000, args.snap_tolerance)
+    server = AssignmentServer((args.host, args.port), AssignmentHandler)
+    print(f"Listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
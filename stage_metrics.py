@@ -0,0 +1,125 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Per-stage instrumentation for the speed limit assignment scripts.
+# Each stage records wall time, CPU time, rows in/out, the spatial test and distance counts the callers add to
+# counters, and cursor opens, and is written as one JSON line to metrics_log (when set). Progress lines carry a rate
+# and ETA.
+
+metrics_log = None
+progress_every = 100
+
+counters = Counter()
+
+
+# Write one JSON line to the metrics log
+def emit(record):
+    record["time"] = time.time()
+    if metrics_log:
+        with open(metrics_log, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+# Count an opened cursor by its type (SearchCursor, UpdateCursor, InsertCursor) and return it
+def opened(cursor):
+    counters[f"{type(cursor).__name__}_opened"] += 1
+    return cursor
+
+
+# Sample the stack of a thread at a fixed interval and count folded stacks (flamegraph.pl input format)
+def sample_stacks(thread_id, stacks, stop_event, interval):
+    while not stop_event.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        if frames:
+            stacks[";".join(reversed(frames))] += 1
+
+
+# Start timing a stage. With profile=True the stage runs under cProfile (written to <name>.prof);
+# with sample=True the calling thread's stacks are sampled and written to <name>.folded for flamegraphs.
+def start_stage(name, rows_in=None, profile=False, sample=False, sample_interval=0.01):
+    stage = {
+        "name": name,
+        "rows_in": rows_in,
+        "wall_start": time.perf_counter(),
+        "cpu_start": time.process_time(),
+        "counters_start": Counter(counters),
+        "profiler": None,
+        "sampler": None,
+    }
+    if profile:
+        stage["profiler"] = cProfile.Profile()
+        stage["profiler"].enable()
+    if sample:
+        stacks = Counter()
+        stop_event = threading.Event()
+        thread = threading.Thread(
+            target=sample_stacks,
+            args=(threading.get_ident(), stacks, stop_event, sample_interval),
+            daemon=True,
+        )
+        thread.start()
+        stage["sampler"] = (thread, stop_event, stacks)
+    print(f"Stage {name} started.")
+    return stage
+
+
+# Finish a stage, print a summary and write its JSON line
+def end_stage(stage, rows_out=None, output_dir="."):
+    wall_seconds = time.perf_counter() - stage["wall_start"]
+    cpu_seconds = time.process_time() - stage["cpu_start"]
+
+    if stage["profiler"] is not None:
+        stage["profiler"].disable()
+        stage["profiler"].dump_stats(os.path.join(output_dir, f"{stage['name']}.prof"))
+    if stage["sampler"] is not None:
+        thread, stop_event, stacks = stage["sampler"]
+        stop_event.set()
+        thread.join()
+        with open(os.path.join(output_dir, f"{stage['name']}.folded"), "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    calls = dict(counters - stage["counters_start"])
+    record = {
+        "event": "stage",
+        "stage": stage["name"],
+        "wall_seconds": wall_seconds,
+        "cpu_seconds": cpu_seconds,
+        "rows_in": stage["rows_in"],
+        "rows_out": rows_out,
+        "calls": calls,
+    }
+    emit(record)
+    calls_text = ", ".join(f"{name}={count}" for name, count in sorted(calls.items()))
+    print(f"Stage {stage['name']} finished in {wall_seconds:.1f} s (CPU {cpu_seconds:.1f} s), "
+          f"rows in/out {stage['rows_in']}/{rows_out}{', ' + calls_text if calls_text else ''}.")
+    return record
+
+
+# Report progress every progress_every rows with the rate and an ETA for the rest of the stage
+def progress(stage, done, total):
+    if done % progress_every != 0 and done != total:
+        return
+    elapsed = time.perf_counter() - stage["wall_start"]
+    rate = done / elapsed if elapsed > 0 else None
+    eta_seconds = (total - done) / rate if rate else None
+    emit({
+        "event": "progress",
+        "stage": stage["name"],
+        "done": done,
+        "total": total,
+        "rows_per_second": rate,
+        "eta_seconds": eta_seconds,
+    })
+    eta_text = f", ETA {eta_seconds / 60:.1f} min" if eta_seconds is not None else ""
+    print(f"Processed {done}/{total} crashes{eta_text}.")
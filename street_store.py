@@ -0,0 +1,232 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Compact in-memory street table: one row per street segment in parallel NumPy arrays, with the vertices of all
+# segments in one coordinate array instead of one geometry object per segment.
+#
+#   ids, levels, speeds   OBJECTID, STREET_LEVEL and SPEED_LIMIT per street (NULL levels and speeds are NaN)
+#   bounds                (x_min, y_min, x_max, y_max) per street
+#   coords                vertices of all streets; street i owns coords[vertex_offsets[i]:vertex_offsets[i + 1]]
+#   segment_starts        first vertex of every line segment (the segment ends at the next vertex); street i owns
+#                         segment_starts[segment_offsets[i]:segment_offsets[i + 1]]. Multipart streets have no
+#                         segment between the end of one part and the start of the next.
+#
+# The nearest-street kernel runs compiled with numba when it is installed (set use_numba = False to compare),
+# and as batched NumPy otherwise.
+
+use_numba = True
+
+
+# Store from rows of (street id, STREET_LEVEL, SPEED_LIMIT, parts), where parts is a list of vertex lists [(x, y), ...].
+# Streets without vertices are left out; positions maps a street id to its row.
+def build_street_store(rows):
+    ids = []
+    levels = []
+    speeds = []
+    coords = []
+    vertex_offsets = [0]
+    segment_starts = []
+    segment_offsets = [0]
+    for street_id, level, speed, parts in rows:
+        parts = [list(part) for part in parts if len(part)]
+        if not parts:
+            continue
+        ids.append(street_id)
+        levels.append(np.nan if level is None else level)
+        speeds.append(np.nan if speed is None else speed)
+        for part in parts:
+            # A single-vertex part is kept as a zero-length segment
+            if len(part) == 1:
+                part = part * 2
+            start = len(coords)
+            coords.extend(part)
+            segment_starts.extend(range(start, start + len(part) - 1))
+        vertex_offsets.append(len(coords))
+        segment_offsets.append(len(segment_starts))
+
+    coords = np.array(coords, dtype=float).reshape(-1, 2)
+    vertex_offsets = np.array(vertex_offsets, dtype=np.int64)
+    if len(ids):
+        starts = vertex_offsets[:-1]
+        bounds = np.column_stack([
+            np.minimum.reduceat(coords[:, 0], starts),
+            np.minimum.reduceat(coords[:, 1], starts),
+            np.maximum.reduceat(coords[:, 0], starts),
+            np.maximum.reduceat(coords[:, 1], starts),
+        ])
+    else:
+        bounds = np.empty((0, 4))
+    return {
+        "ids": np.array(ids, dtype=np.int64),
+        "levels": np.array(levels, dtype=float),
+        "speeds": np.array(speeds, dtype=float),
+        "bounds": bounds,
+        "coords": coords,
+        "vertex_offsets": vertex_offsets,
+        "segment_starts": np.array(segment_starts, dtype=np.int64),
+        "segment_offsets": np.array(segment_offsets, dtype=np.int64),
+        "positions": {street_id: position for position, street_id in enumerate(ids)},
+    }
+
+
+# Concatenated index ranges starts[i]:ends[i], and the start of each range in the result
+def concatenated_ranges(starts, ends):
+    counts = ends - starts
+    range_starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(range_starts - starts, counts), range_starts
+
+
+# Distance from (x, y) to each segment given by its first vertex
+def point_segment_distances(coords, segment_starts, x, y):
+    x0, y0 = coords[segment_starts, 0], coords[segment_starts, 1]
+    dx = coords[segment_starts + 1, 0] - x0
+    dy = coords[segment_starts + 1, 1] - y0
+    length_squared = dx * dx + dy * dy
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = ((x - x0) * dx + (y - y0) * dy) / length_squared
+    # Projection of the point clamped to the segment; zero-length segments are their start vertex. Past the end the
+    # end vertex itself is taken (x0 + 1 * dx can be off by an ulp), so segments sharing a vertex get the same distance.
+    t = np.where(length_squared > 0, np.clip(t, 0.0, 1.0), 0.0)
+    closest_x = np.where(t >= 1.0, coords[segment_starts + 1, 0], x0 + t * dx)
+    closest_y = np.where(t >= 1.0, coords[segment_starts + 1, 1], y0 + t * dy)
+    return np.hypot(closest_x - x, closest_y - y)
+
+
+# Distance from (x, y) to each street at the given positions
+def street_distances(store, positions, x, y):
+    positions = np.asarray(positions, dtype=np.int64)
+    if len(positions) == 0:
+        return np.empty(0)
+    segment_offsets = store["segment_offsets"]
+    segments, first = concatenated_ranges(segment_offsets[positions], segment_offsets[positions + 1])
+    distances = point_segment_distances(store["coords"], store["segment_starts"][segments], x, y)
+    return np.minimum.reduceat(distances, first)
+
+
+# Distance from points to boxes (x_min, y_min, x_max, y_max); 0 inside. Never more than the distance to anything in the box.
+def box_distances(bounds, x, y):
+    dx = np.maximum(np.maximum(bounds[:, 0] - x, x - bounds[:, 2]), 0.0)
+    dy = np.maximum(np.maximum(bounds[:, 1] - y, y - bounds[:, 3]), 0.0)
+    return np.hypot(dx, dy)
+
+
+# Nearest street of many points at once. Point i is compared with the streets at
+# candidates[candidate_offsets[i]:candidate_offsets[i + 1]]. Returns the store position of and distance to each point's
+# nearest candidate (-1 and inf when it has none); store["ids"], store["speeds"] at the positions give the segment ID
+# and speed limit.
+#
+# Pruning: the distance to a street's first vertex bounds its distance from above, the distance to its bounding box
+# from below. Candidates whose box is farther than the best upper bound cannot be nearest and get no exact distance.
+#
+# Ties: distances are exact point-to-segment distances in double precision (the same as distanceTo up to rounding).
+# Among streets at the same distance the lowest store position wins, i.e. the street read first from the cursor,
+# as in a full scan that only replaces the nearest street on a strictly smaller distance.
+def nearest_streets(store, x, y, candidate_offsets, candidates):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    candidate_offsets = np.asarray(candidate_offsets, dtype=np.int64)
+    candidates = np.asarray(candidates, dtype=np.int64)
+    nearest_positions = np.full(len(x), -1, dtype=np.int64)
+    nearest_distances = np.full(len(x), np.inf)
+    if len(candidates) == 0:
+        return nearest_positions, nearest_distances
+    if numba is not None and use_numba:
+        nearest_streets_kernel(x, y, candidate_offsets, candidates, store["bounds"], store["coords"],
+                               store["segment_starts"], store["segment_offsets"], nearest_positions, nearest_distances)
+        return nearest_positions, nearest_distances
+
+    point_of_pair = np.repeat(np.arange(len(x)), np.diff(candidate_offsets))
+    pair_x = x[point_of_pair]
+    pair_y = y[point_of_pair]
+    lower = box_distances(store["bounds"][candidates], pair_x, pair_y)
+    first_vertices = store["coords"][store["vertex_offsets"][candidates]]
+    upper = np.full(len(x), np.inf)
+    np.minimum.at(upper, point_of_pair, np.hypot(first_vertices[:, 0] - pair_x, first_vertices[:, 1] - pair_y))
+    # Boxes exactly at the bound are kept so that ties are still decided by position
+    pairs = np.flatnonzero(lower <= upper[point_of_pair])
+
+    segment_offsets = store["segment_offsets"]
+    segment_starts = segment_offsets[candidates[pairs]]
+    segment_ends = segment_offsets[candidates[pairs] + 1]
+    segments, first = concatenated_ranges(segment_starts, segment_ends)
+    pair_of_segment = np.repeat(pairs, segment_ends - segment_starts)
+    distances = point_segment_distances(store["coords"], store["segment_starts"][segments],
+                                        pair_x[pair_of_segment], pair_y[pair_of_segment])
+    pair_distances = np.minimum.reduceat(distances, first)
+
+    # First pair of each point after sorting by point, distance and position
+    order = np.lexsort((candidates[pairs], pair_distances, point_of_pair[pairs]))
+    points = point_of_pair[pairs][order]
+    best = order[np.r_[True, points[1:] != points[:-1]]]
+    nearest_positions[point_of_pair[pairs][best]] = candidates[pairs][best]
+    nearest_distances[point_of_pair[pairs][best]] = pair_distances[best]
+    return nearest_positions, nearest_distances
+
+
+# Same as nearest_streets, one point at a time: candidates are visited by increasing box distance and the
+# search stops at the first box farther than the best distance found so far. The box distance is taken with hypot like
+# the exact distance, so a box whose corner is the nearest vertex is never bounded above it and equally near streets
+# are not skipped. Compiled with numba when it is installed.
+def nearest_streets_loop(x, y, candidate_offsets, candidates, bounds, coords, segment_starts, segment_offsets,
+                         nearest_positions, nearest_distances):
+    for i in range(len(x)):
+        start = candidate_offsets[i]
+        count = candidate_offsets[i + 1] - start
+        lower = np.empty(count)
+        for k in range(count):
+            box = bounds[candidates[start + k]]
+            dx = max(box[0] - x[i], x[i] - box[2], 0.0)
+            dy = max(box[1] - y[i], y[i] - box[3], 0.0)
+            lower[k] = np.hypot(dx, dy)
+        best_position = -1
+        best_distance = np.inf
+        for k in np.argsort(lower, kind="mergesort"):
+            if lower[k] > best_distance:
+                break
+            position = candidates[start + k]
+            distance = np.inf
+            for segment in range(segment_offsets[position], segment_offsets[position + 1]):
+                vertex = segment_starts[segment]
+                x0, y0 = coords[vertex, 0], coords[vertex, 1]
+                dx, dy = coords[vertex + 1, 0] - x0, coords[vertex + 1, 1] - y0
+                length_squared = dx * dx + dy * dy
+                t = 0.0
+                if length_squared > 0:
+                    t = min(max(((x[i] - x0) * dx + (y[i] - y0) * dy) / length_squared, 0.0), 1.0)
+                closest_x, closest_y = x0 + t * dx, y0 + t * dy
+                if t >= 1.0:
+                    closest_x, closest_y = coords[vertex + 1, 0], coords[vertex + 1, 1]
+                distance = min(distance, np.hypot(closest_x - x[i], closest_y - y[i]))
+            if distance < best_distance or (distance == best_distance and position < best_position):
+                best_distance = distance
+                best_position = position
+        nearest_positions[i] = best_position
+        nearest_distances[i] = best_distance
+
+
+nearest_streets_kernel = numba.njit(cache=True)(nearest_streets_loop) if numba is not None else None
+
+
+# Position of and distance to the nearest of the given streets (the lowest position among equally near streets)
+def nearest_street(store, positions, x, y):
+    nearest_positions, nearest_distances = nearest_streets(store, [x], [y], [0, len(positions)], positions)
+    if nearest_positions[0] < 0:
+        return None, float("inf")
+    return int(nearest_positions[0]), float(nearest_distances[0])
+
+
+# Which of the given streets cross a circle (a buffer around a point): part of the street lies inside and part outside.
+# The closest point of a street to the centre can be anywhere on a segment, the farthest is always a vertex.
+def streets_crossing_circle(store, positions, x, y, radius):
+    positions = np.asarray(positions, dtype=np.int64)
+    if len(positions) == 0:
+        return np.zeros(0, dtype=bool)
+    vertex_offsets = store["vertex_offsets"]
+    vertices, first = concatenated_ranges(vertex_offsets[positions], vertex_offsets[positions + 1])
+    coords = store["coords"]
+    farthest = np.maximum.reduceat(np.hypot(coords[vertices, 0] - x, coords[vertices, 1] - y), first)
+    return (street_distances(store, positions, x, y) < radius) & (farthest > radius)
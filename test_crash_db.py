@@ -0,0 +1,95 @@
+import sqlite3
+
+import crash_db
+
+
+# Local stand-in for the crash table: every crash id below 100 with a speed limit, -1 ("not reported") and NULL mixed in
+def sqlite_connection():
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    conn.execute("CREATE TABLE crashes (crash_id INTEGER PRIMARY KEY, crash_speed_limit INTEGER)")
+    conn.executemany(
+        "INSERT INTO crashes VALUES (?, ?)",
+        ((crash_id, [30, -1, None, 45][crash_id % 4]) for crash_id in range(1, 100)),
+    )
+    conn.commit()
+    return conn
+
+
+def expected_speed_limit(crash_id):
+    return [30, None, None, 45][crash_id % 4]
+
+
+def test_fetch_only_local_ids_over_several_batches():
+    conn = sqlite_connection()
+    local_ids = list(range(10, 60)) + ["61", " 62 ", None, 500]
+    speed_limits = crash_db.fetch_db_speed_limits(conn, local_ids, table="crashes", size=7)
+
+    assert set(speed_limits) == {str(crash_id) for crash_id in list(range(10, 60)) + [61, 62]}
+    for crash_id, speed_limit in speed_limits.items():
+        assert speed_limit == expected_speed_limit(int(crash_id))
+
+
+def test_not_reported_and_null_speed_limits_come_back_as_none():
+    conn = sqlite_connection()
+    speed_limits = crash_db.fetch_db_speed_limits(conn, [4, 5, 6, 7], table="crashes")
+    assert speed_limits == {"4": 30, "5": None, "6": None, "7": 45}
+
+
+def test_async_fetch_matches_the_synchronous_fetch():
+    connections = []
+
+    def connect():
+        connections.append(sqlite_connection())
+        return connections[-1]
+
+    local_ids = list(range(1, 120))
+    future = crash_db.fetch_db_speed_limits_async(connect, local_ids, workers=3, table="crashes", size=10)
+    assert future.result(timeout=30) == crash_db.fetch_db_speed_limits(sqlite_connection(), local_ids, table="crashes")
+    assert len(connections) == 3
+
+
+class StubCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.itersize = None
+        self.query = None
+        self.closed = False
+
+    def execute(self, query, parameters):
+        self.query = (query, parameters)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        self.closed = True
+
+
+# Connection with the parts of the psycopg2 interface fetch_batch uses
+class StubConnection:
+    def __init__(self, rows):
+        self.rows = rows
+        self.cursors = []
+        self.rollbacks = 0
+
+    def cursor(self, name=None):
+        cursor = StubCursor(self.rows)
+        self.cursors.append((name, cursor))
+        return cursor
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def test_postgresql_batches_use_a_server_side_cursor():
+    conn = StubConnection([(1, 25), (2, -1), (3, None)])
+    speed_limits = {}
+    crash_db.fetch_batch(conn, [1, 2, 3], speed_limits, page_size=500)
+
+    assert speed_limits == {"1": 25, "2": None, "3": None}
+    [(name, cursor)] = conn.cursors
+    assert name is not None
+    assert cursor.itersize == 500
+    assert cursor.query[1] == ([1, 2, 3],)
+    assert cursor.closed
+    assert conn.rollbacks == 1
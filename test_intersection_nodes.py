@@ -0,0 +1,59 @@
+import numpy as np
+
+from intersection_nodes import extract_intersection_nodes
+from street_store import build_street_store
+
+
+# Store of streets given as (OBJECTID, STREET_LEVEL, vertex list), each with a single part
+def store_of(streets):
+    return build_street_store((street_id, level, 30, [vertices]) for street_id, level, vertices in streets)
+
+
+# OBJECTIDs of the streets incident to each node
+def incident_ids(nodes):
+    offsets = nodes["incident_offsets"]
+    return [nodes["incident_ids"][offsets[node]:offsets[node + 1]].tolist() for node in range(len(nodes["coords"]))]
+
+
+def test_streets_meeting_at_a_shared_vertex_are_one_node():
+    center = (1000.3, 2000.7)
+    nodes = extract_intersection_nodes(store_of([
+        (11, 1, [center, (1040.1, 2031.9)]),
+        (12, 2, [(960.2, 2012.4), center]),
+        (13, 3, [center, (990.6, 1951.3), (995.0, 1930.0)]),
+        (14, 3, [(1037.5, 1975.2), center]),
+    ]))
+    assert len(nodes["coords"]) == 1
+    np.testing.assert_allclose(nodes["coords"][0], center)
+    assert incident_ids(nodes) == [[11, 12, 13, 14]]
+    assert nodes["level_masks"].tolist() == [0b111]
+
+
+def test_crossing_without_a_shared_vertex_is_a_node():
+    nodes = extract_intersection_nodes(store_of([
+        (1, 1, [(0.0, 0.0), (10.0, 10.0)]),
+        (2, 4, [(0.0, 10.0), (10.0, 0.0)]),
+    ]))
+    assert len(nodes["coords"]) == 1
+    np.testing.assert_allclose(nodes["coords"][0], (5.0, 5.0))
+    assert incident_ids(nodes) == [[1, 2]]
+    assert nodes["level_masks"].tolist() == [0b1001]
+
+
+def test_street_ending_just_short_of_another_is_a_node():
+    nodes = extract_intersection_nodes(store_of([
+        (1, 2, [(0.0, 0.0), (100.0, 0.0)]),
+        (2, 2, [(50.0, 80.0), (50.0, 0.005)]),
+    ]), tolerance=0.01)
+    assert len(nodes["coords"]) == 1
+    np.testing.assert_allclose(nodes["coords"][0], (50.0, 0.005))
+    assert incident_ids(nodes) == [[1, 2]]
+
+
+def test_collinear_overlap_is_not_a_node():
+    nodes = extract_intersection_nodes(store_of([
+        (1, 1, [(0.0, 0.0), (10.0, 0.0)]),
+        (2, 1, [(5.0, 0.0), (15.0, 0.0)]),
+    ]))
+    assert len(nodes["coords"]) == 0
+    assert nodes["incident_offsets"].tolist() == [0]
@@ -0,0 +1,17 @@
+import pytest
+
+import speed_limit_engine as engine
+from benchmark_speed_limits import synthetic_inputs
+
+
+# The tiled run must give exactly the serial result. A search radius of 50 leaves crashes without a street within
+# reach of their tile, so the fallback against the whole street network runs as well.
+@pytest.mark.parametrize("network", ["grid", "organic"])
+def test_parallel_run_matches_serial_run(network, capsys):
+    streets, intersections, crashes = synthetic_inputs(network, 2000, 20000, seed=3)
+    buffers = engine.build_buffers(intersections, streets)
+    serial = engine.assign_speed_limits(crashes, buffers, streets)
+    parallel = engine.assign_speed_limits_parallel(crashes, buffers, streets, workers=4, search_radius=50.0)
+
+    assert "were resolved against all streets" in capsys.readouterr().out
+    assert serial.equals(parallel)
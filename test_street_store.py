@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+import shapely
+
+import street_store
+
+
+# Irregular street network: random nodes joined to their nearest neighbours by polylines with bent interior
+# vertices, so that several streets end at every node and none of the segments are axis-aligned
+def organic_network(seed, node_count=200):
+    rng = np.random.default_rng(seed)
+    nodes = rng.uniform(0, 5000, (node_count, 2))
+    rows = []
+    joined = set()
+    for i in range(node_count):
+        for j in np.argsort(np.hypot(*(nodes - nodes[i]).T))[1:4]:
+            if (min(i, j), max(i, j)) in joined:
+                continue
+            joined.add((min(i, j), max(i, j)))
+            start, end = nodes[i], nodes[j]
+            bends = [start + (end - start) * f + rng.normal(0, 40, 2) for f in np.sort(rng.uniform(0.2, 0.8, rng.integers(0, 3)))]
+            part = [tuple(start)] + [tuple(bend) for bend in bends] + [tuple(end)]
+            rows.append((len(rows) + 1, int(rng.integers(1, 6)), float(rng.choice([25, 30, 35, 45])), [part]))
+    return rows, nodes
+
+
+# Crashes anywhere, and crashes close to the nodes, where the nearest point is often a vertex shared by several streets
+def crash_points(nodes, seed):
+    rng = np.random.default_rng(seed)
+    points = np.r_[rng.uniform(0, 5000, (300, 2)), nodes[rng.integers(0, len(nodes), 1200)] + rng.normal(0, 8, (1200, 2))]
+    return points[:, 0], points[:, 1]
+
+
+# Position and distance of the nearest street by shapely's distance (the GEOS distance behind distanceTo). Distances
+# within rounding of the minimum (coordinates are in the thousands) are ties, which go to the lowest position.
+def shapely_nearest(rows, xs, ys):
+    lines = np.array([shapely.LineString(row[3][0]) for row in rows])
+    line_distances = shapely.distance(shapely.points(xs, ys)[:, None], lines[None, :])
+    minimum = line_distances.min(axis=1)
+    return np.argmax(line_distances <= minimum[:, None] + 1e-9, axis=1), minimum
+
+
+# Every street as a candidate of every point
+def all_candidates(store, point_count):
+    street_count = len(store["ids"])
+    return np.arange(point_count + 1) * street_count, np.tile(np.arange(street_count), point_count)
+
+
+def run_loop(kernel, store, xs, ys):
+    candidate_offsets, candidates = all_candidates(store, len(xs))
+    positions = np.full(len(xs), -1, dtype=np.int64)
+    distances = np.full(len(xs), np.inf)
+    kernel(xs, ys, candidate_offsets, candidates, store["bounds"], store["coords"], store["segment_starts"],
+           store["segment_offsets"], positions, distances)
+    return positions, distances
+
+
+def run_numpy(store, xs, ys, monkeypatch):
+    monkeypatch.setattr(street_store, "use_numba", False)
+    return street_store.nearest_streets(store, xs, ys, *all_candidates(store, len(xs)))
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+@pytest.mark.parametrize("kernel", ["numpy", "loop", "numba"])
+def test_nearest_streets_match_shapely(seed, kernel, monkeypatch):
+    rows, nodes = organic_network(seed)
+    store = street_store.build_street_store(rows)
+    xs, ys = crash_points(nodes, seed + 100)
+    if kernel == "numpy":
+        positions, distances = run_numpy(store, xs, ys, monkeypatch)
+    elif kernel == "loop":
+        positions, distances = run_loop(street_store.nearest_streets_loop, store, xs, ys)
+    else:
+        if street_store.nearest_streets_kernel is None:
+            pytest.skip("numba is not installed")
+        positions, distances = run_loop(street_store.nearest_streets_kernel, store, xs, ys)
+
+    expected_positions, expected_distances = shapely_nearest(rows, xs, ys)
+    np.testing.assert_array_equal(positions, expected_positions)
+    np.testing.assert_allclose(distances, expected_distances, rtol=0, atol=1e-9)